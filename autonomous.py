@@ -0,0 +1,224 @@
+import os
+import json
+import time
+import heapq
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+autonomous_filepath = os.path.join("cache", "autonomous.json")
+
+# seconds a chat has to be idle before the AI may write on its own
+default_idle_after = 6 * 60 * 60
+# local hours [start, end) during which no unprompted messages are sent
+default_quiet_hours = (23, 8)
+# unprompted messages the AI may send in a row before the user has to answer
+max_unprompted_in_a_row = 1
+# unprompted messages across all chats per hour
+max_unprompted_per_hour = 6
+# unprompted generations running at the same time
+max_concurrent_unprompted = 1
+# seconds to wait before trying again when the backend is busy with the user
+busy_retry_seconds = 30.0
+
+autonomous_instructions = (
+    "Some time has passed since the last message. Write a new message to "
+    "{user} on your own, as {ai} would, without waiting for them to reply."
+)
+
+
+def entry_timestamp(entry: dict) -> float:
+    """Seconds since the epoch of a stored message, read as local time like it was written"""
+    return datetime.strptime(
+        f"{entry['date']} {entry['time']}", "%d/%m/%Y %H:%M"
+    ).timestamp()
+
+
+def in_quiet_hours(moment: float, quiet_hours: tuple[int, int]) -> bool:
+    start, end = quiet_hours
+    hour = datetime.fromtimestamp(moment).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def quiet_hours_end(moment: float, quiet_hours: tuple[int, int]) -> float:
+    """The first moment after `moment` that is outside of the quiet hours"""
+    local = datetime.fromtimestamp(moment).replace(minute=0, second=0, microsecond=0)
+    while in_quiet_hours(local.timestamp(), quiet_hours):
+        local += timedelta(hours=1)
+    return max(local.timestamp(), moment)
+
+
+class AutonomousScheduler:
+    """
+    Lets the AI start a conversation in chats that have gone quiet. Every
+    armed chat has one deadline, its last message time plus idle_after, kept
+    in a heap; appends push a new deadline and the old one is skipped when it
+    comes up, so nothing is ever polled and a chat costs nothing until it is
+    due. A background thread sleeps until the earliest deadline.
+
+    Chats are armed with the settings of the conversation (model, cards,
+    system prompt, options), which are kept on disk so armed chats survive a
+    restart. last_entry(chat_filename) returns a chat's newest message,
+    generate(chat_filename, settings) writes one unprompted message, or
+    returns False if it wrote nothing and should be tried again later (a
+    failed attempt is tried again too),
+    and generate_is_idle() tells whether the backend has nothing else to do;
+    unprompted messages only start while it does, so they never get in the
+    way of replies the user is waiting for.
+    """
+
+    def __init__(
+        self,
+        last_entry,
+        generate,
+        generate_is_idle,
+        idle_after: float = default_idle_after,
+        quiet_hours: tuple[int, int] = default_quiet_hours,
+    ):
+        self.last_entry = last_entry
+        self.generate = generate
+        self.generate_is_idle = generate_is_idle
+        self.idle_after = idle_after
+        self.quiet_hours = quiet_hours
+        self.condition = threading.Condition()
+        # chat -> settings of the conversation
+        self.armed = {}
+        # chat -> seconds since the epoch of the last message
+        self.last_message = {}
+        # chat -> unprompted messages since the user last wrote
+        self.unprompted = {}
+        # (due, chat, version); entries whose version is outdated are skipped
+        self.deadlines = []
+        self.versions = {}
+        self.fired = deque()
+        self.running = threading.Semaphore(max_concurrent_unprompted)
+        self._load()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def _load(self):
+        try:
+            with open(autonomous_filepath, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        for chat_filename, settings in saved.items():
+            try:
+                entry = self.last_entry(chat_filename)
+            except (OSError, ValueError) as e:
+                print(f"Could not read the last message of {chat_filename}: {e}")
+                continue
+            self.armed[chat_filename] = settings
+            if entry is not None:
+                self.last_message[chat_filename] = entry_timestamp(entry)
+                self._schedule(chat_filename, self.last_message[chat_filename] + self.idle_after)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(autonomous_filepath), exist_ok=True)
+        tmp_path = autonomous_filepath + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.armed, f, ensure_ascii=False)
+        os.replace(tmp_path, autonomous_filepath)
+
+    def _schedule(self, chat_filename: str, due: float):
+        version = self.versions.get(chat_filename, 0) + 1
+        self.versions[chat_filename] = version
+        heapq.heappush(self.deadlines, (due, chat_filename, version))
+        self.condition.notify_all()
+
+    def arm(self, chat_filename: str, settings: dict):
+        """Allow unprompted messages in a chat the user just wrote in"""
+        with self.condition:
+            changed = self.armed.get(chat_filename) != settings
+            self.armed[chat_filename] = settings
+            self.unprompted[chat_filename] = 0
+            if changed:
+                self._save()
+            if chat_filename not in self.last_message:
+                entry = self.last_entry(chat_filename)
+                if entry is not None:
+                    self.last_message[chat_filename] = entry_timestamp(entry)
+            if chat_filename in self.last_message:
+                self._schedule(chat_filename, self.last_message[chat_filename] + self.idle_after)
+
+    def disarm(self, chat_filename: str):
+        with self.condition:
+            if self.armed.pop(chat_filename, None) is not None:
+                self.versions[chat_filename] = self.versions.get(chat_filename, 0) + 1
+                self._save()
+
+    def note_message(self, chat_filename: str, when: float):
+        """Move a chat's deadline after a message was appended to it"""
+        with self.condition:
+            self.last_message[chat_filename] = when
+            if chat_filename in self.armed:
+                self._schedule(chat_filename, when + self.idle_after)
+
+    def _next_allowed(self, chat_filename: str, now: float) -> float:
+        """None if the chat may get a message now, otherwise when to look again"""
+        if self.unprompted.get(chat_filename, 0) >= max_unprompted_in_a_row:
+            # wait for the user; arm() schedules the chat again
+            return float("inf")
+        if in_quiet_hours(now, self.quiet_hours):
+            return quiet_hours_end(now, self.quiet_hours)
+        while self.fired and self.fired[0] <= now - 3600:
+            self.fired.popleft()
+        if len(self.fired) >= max_unprompted_per_hour:
+            return self.fired[0] + 3600
+        if not self.generate_is_idle():
+            return now + busy_retry_seconds
+        return None
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.time()
+                    if not self.deadlines:
+                        self.condition.wait()
+                        continue
+                    due, chat_filename, version = self.deadlines[0]
+                    if self.versions.get(chat_filename) != version:
+                        heapq.heappop(self.deadlines)
+                        continue
+                    if due > now:
+                        self.condition.wait(due - now)
+                        continue
+                    heapq.heappop(self.deadlines)
+                    retry = self._next_allowed(chat_filename, now)
+                    if retry is not None:
+                        if retry != float("inf"):
+                            self._schedule(chat_filename, retry)
+                        continue
+                    if not self.running.acquire(blocking=False):
+                        self._schedule(chat_filename, now + busy_retry_seconds)
+                        continue
+                    settings = self.armed[chat_filename]
+                    self.unprompted[chat_filename] = self.unprompted.get(chat_filename, 0) + 1
+                    self.fired.append(now)
+                    break
+
+            threading.Thread(
+                target=self._fire, args=(chat_filename, settings), daemon=True
+            ).start()
+
+    def _fire(self, chat_filename: str, settings: dict):
+        try:
+            if self.generate(chat_filename, settings) is False:
+                self._retry(chat_filename)
+        except Exception as e:
+            print(f"Could not write an unprompted message in {chat_filename}: {e}")
+            self._retry(chat_filename)
+        finally:
+            self.running.release()
+
+    def _retry(self, chat_filename: str):
+        """Undo the bookkeeping of a message that wasn't written and try again later"""
+        with self.condition:
+            if self.unprompted.get(chat_filename):
+                self.unprompted[chat_filename] -= 1
+            if self.fired:
+                self.fired.pop()
+            if chat_filename in self.armed:
+                self._schedule(chat_filename, time.time() + busy_retry_seconds)
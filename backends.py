@@ -0,0 +1,297 @@
+import abc
+import json
+import time
+import asyncio
+import hashlib
+
+import httpx
+import ollama
+
+# how endpoints are picked when several serve a model: "affinity" or "least_loaded"
+default_routing = "affinity"
+# an affinity pick is given up for the least loaded endpoint once it has this many more requests
+affinity_slack = 2
+# seconds between health checks, and how long one may take
+health_interval = 15.0
+health_timeout = 5.0
+
+ollama_stat_keys = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
+
+# Ollama options with an equivalent in the OpenAI chat completions API
+openai_option_names = {
+    "num_predict": "max_tokens",
+    "temperature": "temperature",
+    "top_p": "top_p",
+    "top_k": "top_k",
+    "min_p": "min_p",
+    "seed": "seed",
+    "stop": "stop",
+    "repeat_penalty": "repeat_penalty",
+    "presence_penalty": "presence_penalty",
+    "frequency_penalty": "frequency_penalty",
+}
+
+
+class Endpoint(abc.ABC):
+    """
+    One inference server. chat() yields {"content": text} chunks and a last
+    chunk with "done" and whatever of the Ollama timing counters the server
+    reports, so everything above this layer only ever sees Ollama's shape.
+    embed() returns one vector per text.
+    """
+
+    kind = None
+
+    def __init__(self, url: str = None, max_concurrent: int = 1, name: str = None):
+        self.url = url
+        self.max_concurrent = max_concurrent
+        self.name = name or f"{self.kind}:{url or 'default'}"
+        self.in_flight = 0
+        self.healthy = True
+        # model names from the last health check, None until one succeeded
+        self.models = None
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model in self.models
+
+    @abc.abstractmethod
+    async def chat(self, model: str, messages: list[dict], options: dict, keep_alive: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def list_models(self) -> list[str]:
+        raise NotImplementedError
+
+    async def warm_up(self, model: str, keep_alive: str):
+        pass
+
+
+class OllamaEndpoint(Endpoint):
+    kind = "ollama"
+
+    def __init__(self, url: str = None, max_concurrent: int = 1, name: str = None):
+        super().__init__(url, max_concurrent, name)
+        self.client = ollama.AsyncClient(host=url)
+
+    async def chat(self, model, messages, options, keep_alive):
+        stream = await self.client.chat(
+            model,
+            messages=messages,
+            stream=True,
+            options=options,
+            keep_alive=keep_alive,
+        )
+        async for chunk in stream:
+            if chunk.get("done"):
+                yield {
+                    "content": chunk["message"]["content"],
+                    "done": True,
+                    **{key: chunk.get(key) for key in ollama_stat_keys},
+                }
+            else:
+                yield {"content": chunk["message"]["content"]}
+
+    async def embed(self, model, texts):
+        return (await self.client.embed(model=model, input=texts))["embeddings"]
+
+    async def list_models(self):
+        return [model.model for model in (await self.client.list()).models]
+
+    async def warm_up(self, model, keep_alive):
+        await self.client.generate(model=model, prompt="", keep_alive=keep_alive)
+
+
+class OpenAIEndpoint(Endpoint):
+    """
+    An OpenAI-compatible server such as llama.cpp's llama-server or vLLM.
+    Timings come from llama.cpp's "timings" when it sends them, otherwise
+    from the token usage and the time the stream took.
+    """
+
+    kind = "openai"
+
+    def __init__(
+        self,
+        url: str,
+        max_concurrent: int = 1,
+        name: str = None,
+        api_key: str = None,
+    ):
+        super().__init__(url.rstrip("/"), max_concurrent, name)
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else None
+        self.client = httpx.AsyncClient(
+            base_url=self.url, headers=headers, timeout=httpx.Timeout(None, connect=10.0)
+        )
+
+    async def chat(self, model, messages, options, keep_alive):
+        body = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        for key, value in (options or {}).items():
+            if key in openai_option_names:
+                body[openai_option_names[key]] = value
+
+        started = time.monotonic()
+        first_token_at = None
+        usage = None
+        timings = None
+        async with self.client.stream("POST", "/v1/chat/completions", json=body) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get("usage") or usage
+                timings = chunk.get("timings") or timings
+                for choice in chunk.get("choices") or []:
+                    content = (choice.get("delta") or {}).get("content")
+                    if content:
+                        if first_token_at is None:
+                            first_token_at = time.monotonic()
+                        yield {"content": content}
+        finished = time.monotonic()
+
+        stats = {"total_duration": int((finished - started) * 1e9)}
+        if timings:
+            stats["prompt_eval_count"] = timings.get("prompt_n")
+            stats["prompt_eval_duration"] = int((timings.get("prompt_ms") or 0) * 1e6)
+            stats["eval_count"] = timings.get("predicted_n")
+            stats["eval_duration"] = int((timings.get("predicted_ms") or 0) * 1e6)
+        elif usage:
+            first_token_at = first_token_at or finished
+            stats["prompt_eval_count"] = usage.get("prompt_tokens")
+            stats["prompt_eval_duration"] = int((first_token_at - started) * 1e9)
+            stats["eval_count"] = usage.get("completion_tokens")
+            stats["eval_duration"] = int((finished - first_token_at) * 1e9)
+        yield {"content": "", "done": True, **stats}
+
+    async def embed(self, model, texts):
+        response = await self.client.post("/v1/embeddings", json={"model": model, "input": texts})
+        response.raise_for_status()
+        data = sorted(response.json()["data"], key=lambda item: item["index"])
+        return [item["embedding"] for item in data]
+
+    async def list_models(self):
+        response = await self.client.get("/v1/models")
+        response.raise_for_status()
+        return [model["id"] for model in response.json().get("data", [])]
+
+
+endpoint_kinds = {
+    OllamaEndpoint.kind: OllamaEndpoint,
+    OpenAIEndpoint.kind: OpenAIEndpoint,
+}
+
+
+def make_endpoint(spec: dict) -> Endpoint:
+    """Build an endpoint from a dict like {"kind": "openai", "url": ..., "max_concurrent": 2}"""
+    spec = dict(spec)
+    kind = spec.pop("kind", OllamaEndpoint.kind)
+    if kind not in endpoint_kinds:
+        raise ValueError(f"Unknown backend kind {kind}, expected one of {list(endpoint_kinds)}")
+    return endpoint_kinds[kind](**spec)
+
+
+def is_connection_error(e: Exception) -> bool:
+    """Errors that say the server is unreachable rather than that the request was bad"""
+    return isinstance(e, (httpx.TransportError, ConnectionError, OSError))
+
+
+def is_missing_model_error(e: Exception) -> bool:
+    if isinstance(e, ollama.ResponseError):
+        return e.status_code == 404
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 404
+    return False
+
+
+class EndpointRouter:
+    """
+    Picks the server for each request among those that serve the model.
+    With "affinity" routing a chat is hashed onto the same server every time
+    (rendezvous hashing, so losing one server only moves that server's
+    chats), which keeps its prompt in that server's KV cache; it only moves
+    elsewhere when its server is much busier than the least loaded one.
+    "least_loaded" always takes the server with the fewest running requests.
+    Only touched from the BackendPool's event loop.
+    """
+
+    def __init__(self, endpoints: list[Endpoint], routing: str = default_routing):
+        if routing not in ("affinity", "least_loaded"):
+            raise ValueError(f"Unknown routing {routing}")
+        self.endpoints = endpoints
+        self.routing = routing
+
+    def candidates(self, model: str, exclude: set = ()) -> list[Endpoint]:
+        serving = [
+            endpoint
+            for endpoint in self.endpoints
+            if endpoint not in exclude and endpoint.serves(model)
+        ]
+        healthy = [endpoint for endpoint in serving if endpoint.healthy]
+        # a stale health check shouldn't leave a model with nowhere to go
+        return healthy or serving
+
+    def capacity(self, model: str) -> int:
+        return sum(endpoint.max_concurrent for endpoint in self.candidates(model)) or 1
+
+    def pick(self, model: str, chat_key: str, exclude: set = ()) -> Endpoint:
+        candidates = self.candidates(model, exclude)
+        if not candidates:
+            return None
+        least_loaded = min(
+            candidates, key=lambda endpoint: endpoint.in_flight / endpoint.max_concurrent
+        )
+        if self.routing == "least_loaded" or chat_key is None:
+            return least_loaded
+        preferred = max(
+            candidates,
+            key=lambda endpoint: hashlib.sha256(
+                f"{endpoint.name}\0{chat_key}".encode("utf-8")
+            ).digest(),
+        )
+        if preferred.in_flight - least_loaded.in_flight >= affinity_slack:
+            return least_loaded
+        return preferred
+
+    async def check_health(self):
+        async def check(endpoint: Endpoint):
+            try:
+                models = await asyncio.wait_for(endpoint.list_models(), health_timeout)
+            except Exception as e:
+                if endpoint.healthy:
+                    print(f"{endpoint.name} failed its health check: {e}")
+                endpoint.healthy = False
+                return
+            if not endpoint.healthy:
+                print(f"{endpoint.name} is back")
+            endpoint.healthy = True
+            endpoint.models = set(models)
+
+        await asyncio.gather(*(check(endpoint) for endpoint in self.endpoints))
+
+    async def list_models(self) -> list[str]:
+        """Every model some healthy endpoint serves, in endpoint order"""
+        await self.check_health()
+        models = []
+        for endpoint in self.endpoints:
+            if endpoint.healthy and endpoint.models is not None:
+                models.extend(model for model in sorted(endpoint.models) if model not in models)
+        return models
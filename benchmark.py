@@ -0,0 +1,492 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+default_sizes = [1000, 100000, 1000000]
+default_repeat = 5
+# latency of the mock Ollama server
+default_prefill_ms_per_token = 0.2
+default_decode_ms_per_token = 10.0
+default_reply_tokens = 32
+mock_model = "mock:latest"
+mock_embedding_dim = 64
+
+words = (
+    "hey what are you up to today i was thinking about the trip we planned "
+    "did you see that movie yesterday it was so good honestly no way haha "
+    "sure sounds great let me know when you are free maybe later tonight ok"
+).split()
+
+
+def generate_synthetic_chat(path: str, size: int, seed: int = 0):
+    """
+    Write a chat of `size` messages in the chats/ NDJSON format, alternating
+    between Alice and Bob with a few minutes between messages. The same seed
+    always gives the same file.
+    """
+    rng = random.Random(seed)
+    moment = datetime(2025, 1, 1, 9, 0)
+    senders = ["Alice", "Bob"]
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(size):
+            # runs of messages from the same sender, like real texting
+            if rng.random() < 0.6:
+                senders.reverse()
+            moment += timedelta(minutes=rng.randint(0, 30))
+            entry = {
+                "sender": senders[0],
+                "content": " ".join(rng.choices(words, k=rng.randint(3, 40))),
+                "date": moment.strftime("%d/%m/%Y"),
+                "time": moment.strftime("%H:%M"),
+            }
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """
+    Answers the parts of the Ollama API replAI uses, and the same through the
+    OpenAI-compatible API under /v1 like llama.cpp's server and vLLM do.
+    Replies take prefill_ms_per_token per prompt token (about 4 bytes each)
+    before the first token, then decode_ms_per_token per generated token.
+    Models other than the ones in models get a 404, like from a real server.
+    """
+
+    prefill_ms_per_token = default_prefill_ms_per_token
+    decode_ms_per_token = default_decode_ms_per_token
+    reply_tokens = default_reply_tokens
+    models = (mock_model,)
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/v1/models":
+            self._send_json(
+                {"object": "list", "data": [{"id": model, "object": "model"} for model in self.models]}
+            )
+        elif self.path == "/api/tags":
+            self._send_json(
+                {
+                    "models": [
+                        {
+                            "name": model,
+                            "model": model,
+                            "modified_at": "2025-01-01T00:00:00Z",
+                            "size": 0,
+                            "digest": "",
+                            "details": {},
+                        }
+                        for model in self.models
+                    ]
+                }
+            )
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path in ("/api/embed", "/v1/embeddings"):
+            inputs = request.get("input") or []
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            embeddings = [self._embedding(text) for text in inputs]
+            if self.path == "/v1/embeddings":
+                self._send_json(
+                    {
+                        "data": [
+                            {"object": "embedding", "index": index, "embedding": embedding}
+                            for index, embedding in enumerate(embeddings)
+                        ]
+                    }
+                )
+            else:
+                self._send_json({"model": request.get("model"), "embeddings": embeddings})
+        elif self.path in ("/api/chat", "/api/generate", "/v1/chat/completions"):
+            if request.get("model") not in self.models:
+                self._send_json({"error": f"model '{request.get('model')}' not found"}, 404)
+                return
+            try:
+                if self.path == "/v1/chat/completions":
+                    self._openai_reply(request)
+                else:
+                    self._reply(request, chat=self.path == "/api/chat")
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading, e.g. a cancelled or preempted request
+                self.close_connection = True
+        else:
+            self.send_error(404)
+
+    def _embedding(self, text: str) -> list[float]:
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        rng = random.Random(digest)
+        return [rng.uniform(-1, 1) for _ in range(mock_embedding_dim)]
+
+    def _reply(self, request: dict, chat: bool):
+        if chat:
+            prompt = "".join(m.get("content", "") for m in request.get("messages", []))
+        else:
+            prompt = request.get("prompt", "")
+        prompt_tokens = max(len(prompt.encode("utf-8")) // 4, 1)
+        num_predict = (request.get("options") or {}).get("num_predict") or -1
+        reply_tokens = min(num_predict, self.reply_tokens) if num_predict > 0 else self.reply_tokens
+
+        started = time.perf_counter()
+        time.sleep(prompt_tokens * self.prefill_ms_per_token / 1000)
+        prefilled = time.perf_counter()
+
+        def chunk(text: str, done: bool) -> dict:
+            body = {
+                "model": request.get("model"),
+                "created_at": datetime.now().isoformat() + "Z",
+                "done": done,
+            }
+            if chat:
+                body["message"] = {"role": "assistant", "content": text}
+            else:
+                body["response"] = text
+            return body
+
+        tokens = [word + " " for word in random.choices(words, k=reply_tokens)]
+        stream = request.get("stream", True)
+        if stream:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def write(body: dict):
+            data = json.dumps(body).encode("utf-8") + b"\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        for token in tokens:
+            time.sleep(self.decode_ms_per_token / 1000)
+            if stream:
+                write(chunk(token, False))
+        finished = time.perf_counter()
+
+        final = chunk("" if stream else "".join(tokens), True)
+        final.update(
+            {
+                "done_reason": "stop",
+                "total_duration": int((finished - started) * 1e9),
+                "load_duration": 0,
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int((prefilled - started) * 1e9),
+                "eval_count": len(tokens),
+                "eval_duration": int((finished - prefilled) * 1e9),
+            }
+        )
+        if stream:
+            write(final)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        else:
+            self._send_json(final)
+
+    def _openai_reply(self, request: dict):
+        prompt = "".join(m.get("content", "") for m in request.get("messages", []))
+        prompt_tokens = max(len(prompt.encode("utf-8")) // 4, 1)
+        max_tokens = request.get("max_tokens") or self.reply_tokens
+        tokens = [word + " " for word in random.choices(words, k=min(max_tokens, self.reply_tokens))]
+        time.sleep(prompt_tokens * self.prefill_ms_per_token / 1000)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(body):
+            data = f"data: {body if isinstance(body, str) else json.dumps(body)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        for token in tokens:
+            time.sleep(self.decode_ms_per_token / 1000)
+            write({"choices": [{"index": 0, "delta": {"content": token}}]})
+        write({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        write(
+            {
+                "choices": [],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens)},
+            }
+        )
+        write("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def start_mock_ollama(
+    prefill_ms_per_token: float = default_prefill_ms_per_token,
+    decode_ms_per_token: float = default_decode_ms_per_token,
+    reply_tokens: int = default_reply_tokens,
+    models: tuple = (mock_model,),
+) -> ThreadingHTTPServer:
+    """Serve the mock API on a free local port in a background thread"""
+    handler = type(
+        "ConfiguredMockOllamaHandler",
+        (MockOllamaHandler,),
+        {
+            "prefill_ms_per_token": prefill_ms_per_token,
+            "decode_ms_per_token": decode_ms_per_token,
+            "reply_tokens": reply_tokens,
+            "models": tuple(models),
+        },
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def time_calls(fn, repeat: int) -> dict:
+    """Time the first call on its own, as caches are cold then, and the rest together"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    warm = timings[1:] or timings
+    return {
+        "first_s": timings[0],
+        "min_s": min(warm),
+        "median_s": statistics.median(warm),
+        "mean_s": statistics.mean(warm),
+        "runs": len(timings),
+    }
+
+
+@contextmanager
+def cold_chat(gradio_layout, chat: str, phase: str):
+    """
+    A copy of the chat under a new name, with an empty ChatCache, so the first
+    call of a phase finds nothing cached about it, not even its line index
+    """
+    copy = f"{phase}_{chat}"
+    shutil.copyfile(os.path.join("chats", chat), os.path.join("chats", copy))
+    gradio_layout.chat_cache = type(gradio_layout.chat_cache)()
+    try:
+        yield copy
+    finally:
+        # let a background line count finish before its file goes away
+        for cached in list(gradio_layout.chat_cache.chats.values()):
+            cached.indexed.wait()
+        os.remove(os.path.join("chats", copy))
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    sizes: list[int],
+    repeat: int,
+    render_messages: int,
+    cycles: int,
+    prefill_ms_per_token: float,
+    decode_ms_per_token: float,
+    reply_tokens: int,
+) -> dict:
+    """
+    Run every benchmark in a throwaway copy of the working directory, so the
+    real chats and caches are never touched, against the mock Ollama server.
+    """
+    repo_filepath = os.path.dirname(os.path.abspath(__file__))
+    server = start_mock_ollama(prefill_ms_per_token, decode_ms_per_token, reply_tokens)
+    os.environ["OLLAMA_HOST"] = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory(prefix="replai-benchmark-") as work_filepath:
+        for dirname in ("character_cards", "system_prompts", "model_templates"):
+            shutil.copytree(
+                os.path.join(repo_filepath, dirname),
+                os.path.join(work_filepath, dirname),
+            )
+        os.makedirs(os.path.join(work_filepath, "chats"))
+        previous_filepath = os.getcwd()
+        os.chdir(work_filepath)
+        sys.path.insert(0, repo_filepath)
+        try:
+            # imported here, after the environment points it at the mock server
+            import gradio_layout
+
+            results = []
+            for size in sizes:
+                chat = f"synthetic_{size}.ndjson"
+                started = time.perf_counter()
+                generate_synthetic_chat(os.path.join("chats", chat), size)
+                print(f"{size} messages: generated in {time.perf_counter() - started:.1f}s")
+
+                result = {
+                    "size": size,
+                    "bytes": os.path.getsize(os.path.join("chats", chat)),
+                }
+                # every phase starts cold on its own copy, so first_s never hits
+                # what an earlier phase cached
+                with cold_chat(gradio_layout, chat, "full") as copy:
+                    result["load_ndjson_into_memory"] = time_calls(
+                        lambda: gradio_layout.load_ndjson_into_memory(copy), repeat
+                    )
+                    loaded = gradio_layout.load_ndjson_into_memory(copy)
+                with cold_chat(gradio_layout, chat, "last_n") as copy:
+                    result["load_ndjson_into_memory_last_n"] = time_calls(
+                        lambda: gradio_layout.load_ndjson_into_memory(copy, render_messages),
+                        repeat,
+                    )
+                result["sanitize_loaded_ndjson_into_history"] = time_calls(
+                    lambda: gradio_layout.sanitize_loaded_ndjson_into_history(
+                        loaded, "alice.yaml"
+                    ),
+                    repeat,
+                )
+                with cold_chat(gradio_layout, chat, "render") as copy:
+                    result["render_chat"] = time_calls(
+                        lambda: gradio_layout.render_chat(copy, "alice.yaml", render_messages),
+                        repeat,
+                    )
+                with cold_chat(gradio_layout, chat, "page") as copy:
+                    result["show_chat_page"] = time_calls(
+                        lambda: gradio_layout.show_chat_page(copy, "alice.yaml"), repeat
+                    )
+                result["submit_reply_cycle"] = time_submit_cycles(
+                    gradio_layout, chat, cycles
+                )
+                print(json.dumps(result, indent=2))
+                results.append(result)
+        finally:
+            os.chdir(previous_filepath)
+            server.shutdown()
+
+    return {
+        "meta": {
+            "started_at": datetime.now().isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "render_messages": render_messages,
+            "mock_ollama": {
+                "prefill_ms_per_token": prefill_ms_per_token,
+                "decode_ms_per_token": decode_ms_per_token,
+                "reply_tokens": reply_tokens,
+            },
+        },
+        "results": results,
+    }
+
+
+def apply_chat_delta(view: dict, delta: dict) -> dict:
+    """What gradio_layout.apply_chat_delta_js does to chat_view in the browser"""
+    if delta["op"] == "reset":
+        return {"chat": delta["chat"], "first": delta["first"], "count": delta["persisted"]}
+    keep = min(max(delta["first"] - view["first"], 0), view["count"])
+    return {**view, "count": keep + delta["persisted"]}
+
+
+def time_submit_cycles(gradio_layout, chat: str, cycles: int) -> dict:
+    """
+    Time send_and_reply from the user's message to the saved reply, the way
+    the chat tab drives it, with streaming on and no reply delay.
+    """
+    totals = []
+    first_tokens = []
+    update_bytes = []
+    view = None
+    for i in range(cycles):
+        started = time.perf_counter()
+        first_token = None
+        for _, chat_update in gradio_layout.send_and_reply(
+            f"benchmark message {i}",
+            mock_model,
+            chat,
+            "alice.yaml",
+            "bob.yaml",
+            "forced_roleplay.tpl",
+            stream_replies=True,
+            quiet_period=0.0,
+            chat_view=view,
+        ):
+            update_bytes.append(len(json.dumps(chat_update)))
+            if first_token is None and chat_update["messages"]:
+                last = chat_update["messages"][-1]
+                # in-flight bubbles are "[date at time] sender\n\ncontent"
+                content = last["content"].split("\n\n", 1)[-1]
+                if last["role"] == "assistant" and content and not content.startswith("*"):
+                    first_token = time.perf_counter() - started
+        totals.append(time.perf_counter() - started)
+        view = apply_chat_delta(view, chat_update)
+        if first_token is not None:
+            first_tokens.append(first_token)
+    return {
+        "total_median_s": statistics.median(totals),
+        "total_min_s": min(totals),
+        "first_token_median_s": statistics.median(first_tokens) if first_tokens else None,
+        # what the chatbox receives per update, before gradio's own diffing
+        "update_bytes_median": statistics.median(update_bytes),
+        "update_bytes_max": max(update_bytes),
+        "runs": cycles,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time replAI's hot paths on synthetic chats against a mock Ollama server."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=default_sizes)
+    parser.add_argument("--repeat", type=int, default=default_repeat)
+    parser.add_argument("--render-messages", type=int, default=1000)
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--prefill-ms-per-token", type=float, default=default_prefill_ms_per_token)
+    parser.add_argument("--decode-ms-per-token", type=float, default=default_decode_ms_per_token)
+    parser.add_argument("--reply-tokens", type=int, default=default_reply_tokens)
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="JSON file to write the results to, benchmark-<time>.json by default",
+    )
+    args = parser.parse_args()
+
+    report = run_benchmarks(
+        args.sizes,
+        args.repeat,
+        args.render_messages,
+        args.cycles,
+        args.prefill_ms_per_token,
+        args.decode_ms_per_token,
+        args.reply_tokens,
+    )
+    output = args.output or f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
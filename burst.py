@@ -0,0 +1,115 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# seconds without a new user message before the AI starts replying to a burst
+default_quiet_period = 1.5
+
+
+class _Burst:
+    """State of one chat's burst, guarded by its own condition"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.epoch = 0
+        # monotonic time of the last user message
+        self.last_message = 0
+        # callbacks to run when the current epoch is superseded
+        self.watchers = []
+
+
+class BurstCoalescer:
+    """
+    Tracks bursts of user messages per chat. Every user message starts a new
+    epoch; a reply belongs to the epoch it was started in and is abandoned as
+    soon as a newer message arrives, so a burst of messages gets one reply
+    generated over all of them instead of one reply per message.
+
+    Each chat has its own lock, so writing one chat's messages never holds up
+    streaming or writing in another.
+    """
+
+    def __init__(self):
+        # only guards creating entries in self.chats
+        self.lock = threading.Lock()
+        # chat -> _Burst
+        self.chats = {}
+
+    def _burst(self, chat_key: str) -> _Burst:
+        burst = self.chats.get(chat_key)
+        if burst is None:
+            with self.lock:
+                burst = self.chats.setdefault(chat_key, _Burst())
+        return burst
+
+    def note_message(self, chat_key: str, write=None) -> int:
+        """
+        Start a new epoch for a user message. write(), if given, stores the
+        message under the same lock as committing() takes, so a reply from
+        the previous epoch can't be written between the two.
+        """
+        burst = self._burst(chat_key)
+        with burst.condition:
+            if write is not None:
+                write()
+            burst.epoch += 1
+            burst.last_message = time.monotonic()
+            watchers, burst.watchers = burst.watchers, []
+            for callback in watchers:
+                callback()
+            burst.condition.notify_all()
+            return burst.epoch
+
+    def watch(self, chat_key: str, epoch: int, callback):
+        """
+        Call callback() as soon as a newer message supersedes epoch, right away
+        if one already has. Returns a function that stops watching.
+        """
+        burst = self._burst(chat_key)
+        with burst.condition:
+            if burst.epoch != epoch:
+                callback()
+                return lambda: None
+            callbacks = burst.watchers
+            callbacks.append(callback)
+
+        def unwatch():
+            with burst.condition:
+                if callback in callbacks:
+                    callbacks.remove(callback)
+
+        return unwatch
+
+    def current(self, chat_key: str) -> int:
+        # a plain read of an int, so streaming never waits on a write in progress
+        burst = self.chats.get(chat_key)
+        return 0 if burst is None else burst.epoch
+
+    def is_current(self, chat_key: str, epoch: int) -> bool:
+        return self.current(chat_key) == epoch
+
+    def wait_quiet(self, chat_key: str, epoch: int, quiet_period: float) -> bool:
+        """
+        Block until quiet_period seconds have passed since the last user message.
+        Returns False straight away if a newer message takes over the burst.
+        """
+        burst = self._burst(chat_key)
+        with burst.condition:
+            while True:
+                if burst.epoch != epoch:
+                    return False
+                remaining = burst.last_message + quiet_period - time.monotonic()
+                if remaining <= 0:
+                    return True
+                burst.condition.wait(remaining)
+
+    @contextmanager
+    def committing(self, chat_key: str, epoch: int):
+        """
+        Hold off new messages to this chat while a reply is written, yielding
+        whether the reply is still current, so a stale reply never reaches the
+        chat.
+        """
+        burst = self._burst(chat_key)
+        with burst.condition:
+            yield epoch is None or burst.epoch == epoch
@@ -0,0 +1,233 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+from metrics import span
+from ndjson_io import (
+    read_last_lines,
+    last_line_end,
+    update_line_index,
+    indexed_size,
+    index_scan_size,
+    parse_ndjson_lines,
+)
+
+max_cached_chats = 64
+# a chat whose line index lags this many bytes behind is indexed in the background
+background_index_bytes = 4 * index_scan_size
+# tries at counting them in the background, and seconds between tries
+index_attempts = 3
+index_retry_seconds = 1.0
+
+
+class CachedChat:
+    """Parsed tail of one chat file, plus the byte offset it has been read up to"""
+
+    def __init__(self, stat: os.stat_result, offset: int, window: int):
+        self.inode = stat.st_ino
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.offset = offset
+        self.window = window
+        # index within the whole chat of the first line read, None while it is being counted
+        self.base_index = 0
+        # entries dropped from the front since
+        self.trimmed = 0
+        # lines read from the end of the file when it was loaded
+        self.tail_lines = 0
+        self.indexed = threading.Event()
+        self.indexed.set()
+        self.entries = []
+        # user name -> history dicts aligned with self.entries
+        self.histories = {}
+
+    @property
+    def first_index(self) -> int:
+        """Index of self.entries[0] within the whole chat, None if not known yet"""
+        if self.base_index is None:
+            return None
+        return self.base_index + self.trimmed
+
+    def is_stale(self, stat: os.stat_result) -> bool:
+        """True if the file was replaced, truncated or rewritten rather than appended to"""
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            return True
+        return stat.st_size == self.size and stat.st_mtime_ns != self.mtime_ns
+
+    def append(self, entries: list[dict], stat: os.stat_result, offset: int):
+        self.entries.extend(entries)
+        for user_name, history in self.histories.items():
+            history.extend(format_history_entry(entry, user_name) for entry in entries)
+        self.size = stat.st_size
+        self.mtime_ns = stat.st_mtime_ns
+        self.offset = offset
+        # let the lists run over a bit so that trimming is amortized
+        if self.window and len(self.entries) > 2 * self.window:
+            self.trimmed += len(self.entries) - self.window
+            del self.entries[: -self.window]
+            for history in self.histories.values():
+                del history[: -self.window]
+
+
+# shown in place of a line torn by a crash; a real message always starts with its date
+unreadable_content = "[unreadable message]"
+
+
+def format_history_entry(entry: dict, user_name: str) -> dict:
+    if entry.get("unreadable"):
+        return {"role": "assistant", "content": unreadable_content}
+    sender = entry["sender"]
+    role = "user" if sender == user_name else "assistant"
+    timestamp = f"{entry['date']} at {entry['time']}"
+    content = f"[{timestamp}] {sender}\n\n{entry['content']}"
+    return {"role": role, "content": content}
+
+
+def without_unreadable(history: list[dict]) -> list[dict]:
+    """
+    History for a prompt: unreadable lines keep their place in the chat so
+    indexes stay aligned, but the model shouldn't see them as something said
+    """
+    return [message for message in history if message["content"] != unreadable_content]
+
+
+class ChatCache:
+    """
+    Per-chat LRU of parsed NDJSON entries and formatted history. Only bytes
+    appended since the last lookup are parsed; a file that was truncated or
+    replaced is loaded again from scratch.
+
+    Opening a chat only reads its tail. Where that tail starts within the
+    whole chat comes from the line index; if the index is far behind, it is
+    brought up to date in the background and first_index is None until then.
+    """
+
+    def __init__(self, max_chats: int = max_cached_chats):
+        self.max_chats = max_chats
+        self.chats = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _load(self, path: str, stat: os.stat_result, window: int) -> CachedChat:
+        with open(path, "rb") as f:
+            offset = last_line_end(f, stat.st_size)
+        if window:
+            lines = read_last_lines(path, window, end=offset)
+        else:
+            with open(path, "rb") as f:
+                lines = [line for line in f.read(offset).split(b"\n") if line.strip()]
+        chat = CachedChat(stat, offset, window)
+        with span("parse_ndjson"):
+            chat.entries = parse_ndjson_lines(lines)
+        if window:
+            self._count_lines_before(path, chat, len(lines))
+        return chat
+
+    def _lines_before(self, path: str, chat: CachedChat) -> int:
+        """Lines in the file before the tail that was read; raises OSError if it can't be indexed"""
+        offsets, _ = update_line_index(path)
+        return max(bisect_left(offsets, chat.offset) - chat.tail_lines, 0)
+
+    def _count_lines_before(self, path: str, chat: CachedChat, tail_lines: int):
+        chat.tail_lines = tail_lines
+        lag = chat.offset - indexed_size(path)
+        if 0 <= lag <= background_index_bytes:
+            try:
+                chat.base_index = self._lines_before(path, chat)
+                return
+            except OSError as e:
+                print(f"Could not index {path}, trying again in the background: {e}")
+
+        def count_in_background():
+            for _ in range(index_attempts):
+                try:
+                    base_index = self._lines_before(path, chat)
+                except OSError as e:
+                    print(f"Could not index {path}: {e}")
+                    time.sleep(index_retry_seconds)
+                    continue
+                with self.lock:
+                    chat.base_index = base_index
+                break
+            # if every try failed, whoever waits counts the lines itself and sees the error
+            chat.indexed.set()
+
+        chat.base_index = None
+        chat.indexed.clear()
+        threading.Thread(target=count_in_background, daemon=True).start()
+
+    def _refresh(self, path: str, chat: CachedChat, stat: os.stat_result):
+        if stat.st_size == chat.offset:
+            chat.size, chat.mtime_ns = stat.st_size, stat.st_mtime_ns
+            return
+        with open(path, "rb") as f:
+            f.seek(chat.offset)
+            data = f.read(stat.st_size - chat.offset)
+        complete = data.rfind(b"\n") + 1
+        lines = [line for line in data[:complete].split(b"\n") if line.strip()]
+        with span("parse_ndjson"):
+            chat.append(parse_ndjson_lines(lines), stat, chat.offset + complete)
+
+    def get(self, path: str, max_entries: int = None) -> CachedChat:
+        stat = os.stat(path)
+        with self.lock:
+            chat = self.chats.get(path)
+            if (
+                chat is None
+                or chat.is_stale(stat)
+                or (chat.window and (not max_entries or max_entries > chat.window))
+            ):
+                chat = self._load(path, stat, max_entries)
+            else:
+                self._refresh(path, chat, stat)
+            self.chats[path] = chat
+            self.chats.move_to_end(path)
+            while len(self.chats) > self.max_chats:
+                self.chats.popitem(last=False)
+            return chat
+
+    def entries(self, path: str, max_entries: int = None) -> list[dict]:
+        chat = self.get(path, max_entries)
+        with self.lock:
+            entries = chat.entries
+            return entries[-max_entries:] if max_entries else list(entries)
+
+    def history(self, path: str, user_name: str, max_entries: int = None) -> list[dict]:
+        return self.history_window(path, user_name, max_entries)[1]
+
+    def history_window(
+        self, path: str, user_name: str, max_entries: int = None, wait: bool = True
+    ) -> tuple[int, list[dict]]:
+        """
+        Like history, but also returns the index of the first message within
+        the chat. With wait=False that index is None while it is still being
+        counted, rather than waiting for it.
+        """
+        chat = self.get(path, max_entries)
+        if wait and chat.base_index is None:
+            chat.indexed.wait()
+            if chat.base_index is None:
+                base_index = self._lines_before(path, chat)
+                with self.lock:
+                    chat.base_index = base_index
+        with self.lock:
+            history = chat.histories.get(user_name)
+            if history is None:
+                with span("format_history"):
+                    history = [format_history_entry(e, user_name) for e in chat.entries]
+                chat.histories[user_name] = history
+            first_index = chat.first_index
+            if max_entries and len(history) > max_entries:
+                skipped = len(history) - max_entries
+                if first_index is not None:
+                    first_index += skipped
+                return first_index, history[skipped:]
+            return first_index, list(history)
+
+    def invalidate(self, path: str = None):
+        with self.lock:
+            if path is None:
+                self.chats.clear()
+            else:
+                self.chats.pop(path, None)
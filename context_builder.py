@@ -0,0 +1,58 @@
+from functools import lru_cache
+
+# tokens added around every message by the chat template (role markers etc.)
+message_overhead_tokens = 4
+# history is dropped this many messages at a time so the prompt prefix stays stable
+drop_chunk_size = 32
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast heuristic for when no real tokenizer is available: ~4 bytes per token"""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+_count_tokens = lru_cache(maxsize=65536)(estimate_tokens)
+
+
+def set_tokenizer(count_tokens=None):
+    """
+    Plug in a real token counter, e.g. lambda text: len(tok.encode(text)).
+    Passing None goes back to the heuristic. Counts are memoized per text.
+    """
+    global _count_tokens
+    _count_tokens = lru_cache(maxsize=65536)(count_tokens or estimate_tokens)
+
+
+def count_message_tokens(message: dict) -> int:
+    return _count_tokens(message["content"]) + message_overhead_tokens
+
+
+def build_context(
+    system_msg: dict,
+    history: list[dict],
+    first_index: int,
+    budget: int,
+    chunk_size: int = drop_chunk_size,
+) -> list[dict]:
+    """
+    Pack the system message and as many of the most recent messages as fit in
+    budget tokens. first_index is the position of history[0] within the whole
+    chat. The oldest kept message is always on a chunk_size boundary of the
+    chat, so between turns the prompt only grows at the end, and Ollama can
+    reuse its KV cache, until a whole chunk has to be dropped at once.
+    """
+    remaining = budget - count_message_tokens(system_msg)
+
+    start = len(history)
+    while start > 0:
+        cost = count_message_tokens(history[start - 1])
+        if cost > remaining:
+            break
+        remaining -= cost
+        start -= 1
+
+    chunk_start = first_index + start
+    chunk_start = -(-chunk_start // chunk_size) * chunk_size
+    start = min(chunk_start - first_index, len(history))
+
+    return [system_msg, *history[start:]]
@@ -1,70 +1,333 @@
 import gradio as gr
-import ollama
 import os
-import json
-import re
 from datetime import datetime
+import threading
+import time
+import itertools
 import yaml
-from jinja2 import Template
+from ndjson_io import read_line_range, parse_ndjson_lines, get_writer, count_lines
+from chat_cache import ChatCache, format_history_entry, without_unreadable
+from registry import PromptRegistry
+from context_builder import build_context, count_message_tokens
+from memory import MemoryManager, backend_embedder
+from summarizer import Summarizer
+from burst import BurstCoalescer, default_quiet_period
+from prefill import Prefiller
+from autonomous import AutonomousScheduler, autonomous_instructions
+from group_chat import (
+    choose_speakers,
+    participant_view,
+    shared_history,
+    default_speakers_per_round,
+)
+from sqlite_store import is_sqlite_chat, open_store, to_timestamp
+from search import SearchIndex
+from ollama_backend import BackendPool, BackendBusy, ModelList
+from metrics import span, Trace, default_metrics_port
 
 chats_filepath = "chats"
 sys_prompts_filepath = "system_prompts"
 character_cards_filepath = "character_cards"
 model_templates_filepath = "model_templates"
+# how hard NDJSON appends try to reach the disk: "none", "datasync" or "fsync"
+chat_durability = "datasync"
+# port of the local Prometheus /metrics endpoint started by main.py, None to turn it off
+metrics_port = default_metrics_port
+# per-reply stage timings are appended here as NDJSON, e.g. "cache/traces.ndjson"; None turns it off
+trace_log_filepath = None
+
+chat_cache = ChatCache()
+prompt_registry = PromptRegistry(character_cards_filepath, sys_prompts_filepath)
+
+# order matches the sliders in the Model Settings tab
+model_option_keys = [
+    "temperature",
+    "top_p",
+    "top_k",
+    "tfs_z",
+    "mirostat",
+    "mirostat_tau",
+    "mirostat_eta",
+    "num_predict",
+    "num_ctx",
+    "repeat_last_n",
+    "repeat_penalty",
+]
+default_keep_alive = "30m"
+
+# inference servers to spread generations over, see backends.make_endpoint, e.g.
+# {"kind": "ollama", "url": "http://10.0.0.2:11434", "max_concurrent": 2} or
+# {"kind": "openai", "url": "http://10.0.0.3:8080"} for llama.cpp's llama-server or vLLM
+backend_endpoints = [{"kind": "ollama", "url": None, "max_concurrent": 1}]
+# "affinity" keeps each chat on the same server so its prompt stays cached there,
+# "least_loaded" always uses the least busy server
+backend_routing = "affinity"
+
+backend_pool = BackendPool(endpoints=backend_endpoints, routing=backend_routing)
+burst_coalescer = BurstCoalescer()
+prefiller = Prefiller(backend_pool)
+# tokens of the context set aside for recalled messages when memory is on
+memory_token_budget = 384
+memory_recall_k = 8
+# how many of the latest messages make up the memory search query
+memory_query_messages = 3
+# messages shown when a chat is opened, and loaded per click on "Load Older Messages"
+chat_page_size = 50
+_chat_delta_seq = itertools.count()
+# applies a delta from chat_delta() to the chatbox in the browser and keeps track of
+# which messages it shows in chat_view, so events only send the messages that changed
+apply_chat_delta_js = """
+(history, view, delta) => {
+    if (!delta) return [history, view];
+    const messages = delta.messages.map((m) => ({ metadata: null, options: null, ...m }));
+    if (delta.op === "reset") {
+        return [messages, { chat: delta.chat, first: delta.first, count: delta.persisted }];
+    }
+    if (!view || view.chat !== delta.chat) return [history, view];
+    history = history || [];
+    if (delta.op === "prepend") {
+        const count = view.count + delta.persisted;
+        return [[...messages, ...history], { chat: view.chat, first: delta.first, count: count }];
+    }
+    const keep = Math.min(Math.max(delta.first - view.first, 0), view.count);
+    const count = keep + delta.persisted;
+    return [[...history.slice(0, keep), ...messages], { chat: view.chat, first: view.first, count: count }];
+}
+"""
+# seconds between checks of the open chat for messages the AI wrote on its own
+autonomous_refresh_seconds = 30
+# how often a group chat round refreshes the in-flight messages, in seconds
+group_poll_seconds = 0.1
+# tokens of the context set aside for summaries of older history when summaries are on
+summary_token_budget = 384
+model_list = ModelList(fetch=backend_pool.list_models)
+# fetch the model list now so it is usually ready by the time a page loads
+model_list.refresh()
+# how long a page load waits for Ollama before showing the last known model list
+model_list_wait = 2.0
 
 
 def list_files_in_filepath(filepath):
+    if not os.path.isdir(filepath):
+        return []
     directory = os.listdir(filepath)
     files = [file for file in directory]
     return files
 
 
-def list_ollama_models():
-    ollama_list = ollama.list()
-    models = [model.model for model in ollama_list.models]
-    return models
+def list_chats():
+    """Chat files of either backend, leaving out SQLite's WAL and shared-memory files"""
+    return [
+        file
+        for file in list_files_in_filepath(chats_filepath)
+        if not file.endswith(("-wal", "-shm", "-journal"))
+    ]
+
+
+def list_ollama_models(wait: float = 0, refresh: bool = False):
+    """Cached model names; Ollama is only asked in the background, at most once per TTL"""
+    if refresh:
+        return model_list.refresh(wait)
+    return model_list.get(wait)
+
+
+def refresh_model_dropdowns():
+    models = list_ollama_models(wait=model_list_wait, refresh=True)
+    return gr.update(choices=models), gr.update(choices=models), gr.update(choices=models)
+
+
+def populate_dropdowns():
+    """Fill the dropdowns when the page loads rather than while building the layout"""
+    models = list_ollama_models(wait=model_list_wait)
+    chats = list_chats()
+    cards = list_files_in_filepath(character_cards_filepath)
+    prompts = list_files_in_filepath(sys_prompts_filepath)
+    templates = list_files_in_filepath(model_templates_filepath)
+    return (
+        gr.update(choices=models),
+        gr.update(choices=templates),
+        gr.update(choices=cards),
+        gr.update(choices=prompts),
+        gr.update(choices=chats),
+        gr.update(choices=models),
+        gr.update(choices=cards),
+        gr.update(choices=cards),
+        gr.update(choices=prompts),
+        gr.update(choices=chats),
+        gr.update(choices=models),
+        gr.update(choices=cards),
+        gr.update(choices=cards),
+        gr.update(choices=prompts),
+        gr.update(choices=chats),
+    )
+
+
+def editable_path(filepath: str, filename: str) -> str:
+    """Path of a file named in a textbox, which must stay inside filepath"""
+    if not filename:
+        raise gr.Error("Enter a filename first.")
+    separators = [sep for sep in (os.sep, os.altsep) if sep]
+    if (
+        any(sep in filename for sep in separators)
+        or filename != os.path.basename(filename)
+        or filename in (os.curdir, os.pardir)
+    ):
+        raise gr.Error(f"{filename} is not a plain filename.")
+    return os.path.join(filepath, filename)
 
 
 def load_and_display_file(filepath: str, filename: str):
     """Fetch a file and render it in a textbox"""
-    path = os.path.join(filepath, filename)
     try:
+        path = editable_path(filepath, filename)
         with open(path, "r", encoding="utf-8") as f:
             return f.read()
     except Exception as e:
         return f"Error loading file: {str(e)}"
 
 
+def save_file(filepath: str, filename: str, content: str):
+    """Write a file from an editor tab and refresh the dropdown listing the folder"""
+    path = editable_path(filepath, filename)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content or "")
+    prompt_registry.refresh()
+    return gr.update(choices=list_files_in_filepath(filepath), value=filename)
+
+
+def delete_file(filepath: str, filename: str):
+    path = editable_path(filepath, filename)
+    if os.path.exists(path):
+        os.remove(path)
+    prompt_registry.refresh()
+    return gr.update(choices=list_files_in_filepath(filepath), value=None), ""
+
+
+def build_model_options(override_defaults: bool, *values) -> dict:
+    """Ollama options from the Model Settings sliders, empty to keep the modelfile defaults"""
+    if not override_defaults:
+        return {}
+    return dict(zip(model_option_keys, values))
+
+
+def generation_options(options: dict, num_ctx: int, num_predict: int) -> dict:
+    """
+    options plus the num_ctx and num_predict the prompt was packed for. These
+    are always sent, even without Override Defaults, as otherwise the model
+    runs with its modelfile's context size and cuts the prompt short.
+    """
+    return {**(options or {}), "num_ctx": int(num_ctx), "num_predict": int(num_predict)}
+
+
+def write_model_template(filename: str, model: str, *values):
+    path = editable_path(model_templates_filepath, filename)
+    template = {"model": model, "options": dict(zip(model_option_keys, values))}
+    os.makedirs(model_templates_filepath, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(template, f, sort_keys=False)
+    return gr.update(
+        choices=list_files_in_filepath(model_templates_filepath), value=filename
+    )
+
+
+def load_model_template(filename: str):
+    """Filename, model and slider values stored in a model template"""
+    path = editable_path(model_templates_filepath, filename)
+    with open(path, encoding="utf-8") as f:
+        template = yaml.safe_load(f) or {}
+    options = template.get("options", {})
+    values = [options.get(key, gr.update()) for key in model_option_keys]
+    return filename, template.get("model") or gr.update(), *values
+
+
+def remove_model_template(filename: str):
+    path = editable_path(model_templates_filepath, filename)
+    if os.path.exists(path):
+        os.remove(path)
+    return gr.update(choices=list_files_in_filepath(model_templates_filepath), value=None)
+
+
+def warm_up_model(model_name: str, keep_alive: str = default_keep_alive):
+    """Load the model into memory in the background so the first reply doesn't wait for it"""
+    if not model_name:
+        return
+    backend_pool.warm_up(model_name, keep_alive or None)
+
+
 def load_ndjson_into_memory(
     ndjson_filename: str,
     max_entries: int = None,
 ) -> list[dict]:
     path = os.path.join(chats_filepath, ndjson_filename)
+    if is_sqlite_chat(ndjson_filename):
+        return open_store(path).last(max_entries)
+    return chat_cache.entries(path, max_entries)
+
+
+def load_ndjson_range(
+    ndjson_filename: str,
+    start: int,
+    stop: int,
+) -> list[dict]:
+    """Load messages [start, stop) of a chat through its line index"""
+    path = os.path.join(chats_filepath, ndjson_filename)
+    if is_sqlite_chat(ndjson_filename):
+        return open_store(path).range(start, stop)
+    return parse_ndjson_lines(read_line_range(path, start, stop))
+
+
+def count_chat_messages(ndjson_filename: str) -> int:
+    path = os.path.join(chats_filepath, ndjson_filename)
+    if is_sqlite_chat(ndjson_filename):
+        return open_store(path).count()
+    return count_lines(path)
+
 
-    entries = []
-    with open(path, "r", encoding="utf-8") as f:
-        entries = [json.loads(line) for line in f if line.strip()]
-    max_entries = min(len(entries), max_entries)
-    return entries[-max_entries:] if max_entries else entries
+def chat_size(ndjson_filename: str) -> int:
+    """Size of an NDJSON chat, to notice it being rewritten; SQLite chats only go by count"""
+    if is_sqlite_chat(ndjson_filename):
+        return 0
+    return os.path.getsize(os.path.join(chats_filepath, ndjson_filename))
 
 
 def sanitize_loaded_ndjson_into_history(
     loaded_ndjson: list[dict],
     chara_card_filename: str,
 ) -> list[dict]:
-    chara_card_path = os.path.join(character_cards_filepath, chara_card_filename)
-    with open(chara_card_path) as f:
-        chara_card = yaml.safe_load(f)
-        user_name = chara_card.get("name")
+    user_name = prompt_registry.card_name(chara_card_filename)
+    return [format_history_entry(entry, user_name) for entry in loaded_ndjson]
 
-    history = []
-    for entry in loaded_ndjson:
-        sender = entry["sender"]
-        role = "user" if sender == user_name else "assistant"
-        timestamp = f"{entry['date']} at {entry['time']}"
-        content = f"[{timestamp}] {sender}\n\n{entry['content']}"
-        history.append({"role": role, "content": content})
-    return history
+
+def load_chat_history(
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    max_entries: int = None,
+) -> list[dict]:
+    """Cached equivalent of load_ndjson_into_memory + sanitize_loaded_ndjson_into_history"""
+    return load_chat_history_window(
+        ndjson_filename, user_chara_card_filename, max_entries
+    )[1]
+
+
+def load_chat_history_window(
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    max_entries: int = None,
+    wait_for_index: bool = True,
+) -> tuple[int, list[dict]]:
+    """
+    History plus the index of its first message within the chat. Without
+    wait_for_index that index is None while a newly opened chat is still
+    being counted.
+    """
+    user_name = prompt_registry.card_name(user_chara_card_filename)
+    path = os.path.join(chats_filepath, ndjson_filename)
+    if is_sqlite_chat(ndjson_filename):
+        store = open_store(path)
+        entries = store.last(max_entries)
+        history = [format_history_entry(entry, user_name) for entry in entries]
+        return store.count() - len(entries), history
+    return chat_cache.history_window(path, user_name, max_entries, wait_for_index)
 
 
 def sanitize_and_send_message(
@@ -72,10 +335,7 @@ def sanitize_and_send_message(
     sender_chara_card_filename,
     content: str,
 ):
-    chara_card_path = os.path.join(character_cards_filepath, sender_chara_card_filename)
-    with open(chara_card_path) as f:
-        chara_card = yaml.safe_load(f)
-        chara_name = chara_card.get("name")
+    chara_name = prompt_registry.card_name(sender_chara_card_filename)
 
     safe_content = content.replace("\n", " ").strip()
 
@@ -92,8 +352,125 @@ def sanitize_and_send_message(
 
     path = os.path.join(chats_filepath, ndjson_filename)
 
-    with open(path, "a", encoding="utf-8") as f:
-        f.write(json.dumps(message, ensure_ascii=False) + "\n")
+    if is_sqlite_chat(ndjson_filename):
+        open_store(path).append(message)
+    else:
+        get_writer(path, chat_durability).append(message)
+    memory_manager.notify(ndjson_filename)
+    search_index.notify(ndjson_filename)
+    autonomous_scheduler.note_message(ndjson_filename, now.timestamp())
+
+
+def send_user_message(
+    ndjson_filename,
+    user_chara_card_filename,
+    content: str,
+) -> int:
+    """Send the user's message and start a new burst, returning its epoch"""
+    return burst_coalescer.note_message(
+        ndjson_filename,
+        lambda: sanitize_and_send_message(
+            ndjson_filename, user_chara_card_filename, content
+        ),
+    )
+
+
+def commit_reply(
+    ndjson_filename,
+    ai_chara_card_filename,
+    model_message: str,
+    burst_epoch: int = None,
+) -> bool:
+    """Write the AI's reply unless the user has sent another message since it was started"""
+    with burst_coalescer.committing(ndjson_filename, burst_epoch) as current:
+        if current:
+            sanitize_and_send_message(
+                ndjson_filename, ai_chara_card_filename, model_message
+            )
+        return current
+
+
+def build_chat_messages(
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filename: str,
+    sys_prompt_filename: str,
+    num_messages: int = 1000,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    use_memory: bool = False,
+    summary_model: str = None,
+    recall_memory: bool = True,
+) -> list[dict]:
+    """
+    System message plus as much recent history as fits in num_ctx - num_predict
+    tokens. With use_memory, part of the budget goes to older messages recalled
+    by embedding similarity, added after the history so the prefix stays stable.
+    With a summary_model, another part goes to summaries of the history that no
+    longer fits; they are computed in the background, never while replying.
+    Without recall_memory the budget is still set aside but nothing is
+    recalled, which gives the prefix the full prompt will start with.
+    """
+    system_message = prompt_registry.system_message(
+        sys_prompt_filename, ai_chara_card_filename, user_chara_card_filename
+    )
+    system_msg = {"role": "system", "content": system_message}
+
+    with span("load_history"):
+        first_index, curated = load_chat_history_window(
+            ndjson_filename, user_chara_card_filename, num_messages
+        )
+
+    budget = num_ctx - num_predict
+    if use_memory:
+        budget -= memory_token_budget
+    if summary_model:
+        budget -= summary_token_budget
+    with span("pack_context"):
+        messages = build_context(system_msg, curated, first_index, budget)
+    oldest_in_context = first_index + len(curated) - (len(messages) - 1)
+    messages = without_unreadable(messages)
+
+    if summary_model:
+        summarizer.request(ndjson_filename, summary_model, oldest_in_context)
+        with span("summaries"):
+            summaries, replaced_tokens = summarizer.summaries_before(
+                ndjson_filename, summary_model, oldest_in_context, summary_token_budget
+            )
+        if summaries:
+            summary_msg = {
+                "role": "system",
+                "content": "Summary of the earlier conversation:\n"
+                + "\n\n".join(summaries),
+            }
+            messages.insert(1, summary_msg)
+            summarizer.stats.record_reduction(
+                replaced_tokens, count_message_tokens(summary_msg)
+            )
+
+    if not use_memory or not recall_memory:
+        return messages
+
+    with span("memory_recall"):
+        recent = load_ndjson_into_memory(ndjson_filename, memory_query_messages)
+        recalled = memory_manager.recall(
+            ndjson_filename, recent, oldest_in_context, memory_recall_k
+        )
+
+    lines = []
+    remaining = memory_token_budget
+    for entry in recalled:
+        if entry.get("unreadable"):
+            continue
+        line = f"[{entry['date']} at {entry['time']}] {entry['sender']}: {entry['content']}"
+        remaining -= count_message_tokens({"content": line})
+        if remaining < 0:
+            break
+        lines.append(line)
+    if lines:
+        memory_text = "Earlier messages from this chat that may be relevant:\n"
+        messages.append({"role": "system", "content": memory_text + "\n".join(lines)})
+    return messages
 
 
 def ollama_generate_message(
@@ -103,36 +480,520 @@ def ollama_generate_message(
     ai_chara_card_filename: str,
     sys_prompt_filename: str,
     num_messages: int = 1000,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    use_memory: bool = False,
+    use_summaries: bool = False,
+    burst_epoch: int = None,
 ):
-    sys_prompt_path = os.path.join(sys_prompts_filepath, sys_prompt_filename)
-    ai_chara_card_path = os.path.join(character_cards_filepath, ai_chara_card_filename)
-    user_chara_card_path = os.path.join(
-        character_cards_filepath, user_chara_card_filename
-    )
-
-    with open(ai_chara_card_path) as f:
-        ai_card = yaml.safe_load(f)
-    with open(user_chara_card_path) as f:
-        user_card = yaml.safe_load(f)
-    with open(sys_prompt_path) as f:
-        tpl_text = f.read()
-    system_message = Template(tpl_text).render(
-        ai={
-            "name": ai_card["name"],
-            "description": ai_card["description"],
-        },
-        user={"name": user_card["name"], "description": user_card["description"]},
+    trace = Trace("reply", chat=ndjson_filename, model=model_name, stream=False)
+    with trace.active(), span("build_prompt"):
+        messages = build_chat_messages(
+            ndjson_filename,
+            user_chara_card_filename,
+            ai_chara_card_filename,
+            sys_prompt_filename,
+            num_messages,
+            num_ctx,
+            num_predict,
+            use_memory,
+            model_name if use_summaries else None,
+        )
+
+    warm = prefiller.is_warm(ndjson_filename, messages)
+    job = backend_pool.submit(
+        model_name,
+        ndjson_filename,
+        messages,
+        generation_options(options, num_ctx, num_predict),
+        keep_alive,
     )
-    system_msg = {"role": "system", "content": system_message}
-    in_mem = load_ndjson_into_memory(ndjson_filename, num_messages)
-    curated = sanitize_loaded_ndjson_into_history(in_mem, user_chara_card_filename)
+    # a newer user message cancels the job, so it stops holding the model
+    unwatch = (
+        burst_coalescer.watch(ndjson_filename, burst_epoch, job.cancel)
+        if burst_epoch is not None
+        else lambda: None
+    )
+    try:
+        model_message = job.result()
+    finally:
+        unwatch()
+    if model_message is None:
+        trace.finish()
+        return
+    prefiller.record_reply(warm, job.time_to_first_token)
+    summarizer.stats.record("summarized" if use_summaries else "raw", job.stats)
+    trace.record_generation(model_name, job)
 
-    messages = [system_msg, *curated]
+    with trace.active(), span("commit"):
+        commit_reply(ndjson_filename, ai_chara_card_filename, model_message, burst_epoch)
+    trace.finish()
 
-    response = ollama.chat(model_name, messages=messages)
-    model_message = response["message"]["content"]
 
-    sanitize_and_send_message(ndjson_filename, ai_chara_card_filename, model_message)
+def ollama_stream_message(
+    model_name: str,
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filename: str,
+    sys_prompt_filename: str,
+    num_messages: int = 1000,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    use_memory: bool = False,
+    use_summaries: bool = False,
+    burst_epoch: int = None,
+):
+    """
+    Stream the reply through the backend pool, yielding ("queued", position)
+    while waiting for the model and ("token", text so far) after every token.
+    The message is only written to the chat once the stream completes, so a
+    cancelled generation leaves the chat untouched. With a burst_epoch, the
+    stream is abandoned as soon as the user sends another message.
+    """
+    trace = Trace("reply", chat=ndjson_filename, model=model_name, stream=True)
+    with trace.active(), span("build_prompt"):
+        messages = build_chat_messages(
+            ndjson_filename,
+            user_chara_card_filename,
+            ai_chara_card_filename,
+            sys_prompt_filename,
+            num_messages,
+            num_ctx,
+            num_predict,
+            use_memory,
+            model_name if use_summaries else None,
+        )
+
+    warm = prefiller.is_warm(ndjson_filename, messages)
+    job = backend_pool.submit(
+        model_name,
+        ndjson_filename,
+        messages,
+        generation_options(options, num_ctx, num_predict),
+        keep_alive,
+    )
+    # closing job.stream() early, e.g. when gradio cancels us, cancels the request
+    events = job.stream()
+    for kind, value in events:
+        if burst_epoch is not None and not burst_coalescer.is_current(
+            ndjson_filename, burst_epoch
+        ):
+            events.close()
+            return
+        if kind == "done":
+            model_message = value
+        else:
+            yield kind, value
+    prefiller.record_reply(warm, job.time_to_first_token)
+    summarizer.stats.record("summarized" if use_summaries else "raw", job.stats)
+    trace.record_generation(model_name, job)
+
+    with trace.active(), span("commit"):
+        commit_reply(ndjson_filename, ai_chara_card_filename, model_message, burst_epoch)
+    trace.finish()
+
+
+def stream_reply_into_chat(
+    model_name: str,
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filename: str,
+    sys_prompt_filename: str,
+    stream_replies: bool = True,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    use_memory: bool = False,
+    use_summaries: bool = False,
+    burst_epoch: int = None,
+    quiet_period: float = default_quiet_period,
+    num_messages: int = 1000,
+    shown_until: int = None,
+):
+    """
+    Event handler that shows the AI's reply in the chatbox while it is being
+    generated. With a burst_epoch it first waits for the user to stop typing
+    for quiet_period seconds, and gives up if another message comes in, as
+    that message's handler then replies to the whole burst. Yields chat
+    deltas for the messages from shown_until on, see chat_delta.
+    """
+    if burst_epoch is not None and not burst_coalescer.wait_quiet(
+        ndjson_filename, burst_epoch, quiet_period
+    ):
+        return
+
+    if not stream_replies:
+        try:
+            ollama_generate_message(
+                model_name,
+                ndjson_filename,
+                user_chara_card_filename,
+                ai_chara_card_filename,
+                sys_prompt_filename,
+                num_messages,
+                num_ctx,
+                num_predict,
+                options,
+                keep_alive,
+                use_memory,
+                use_summaries,
+                burst_epoch,
+            )
+        except BackendBusy as e:
+            raise gr.Error(str(e))
+        yield chat_delta(ndjson_filename, user_chara_card_filename, shown_until)
+        return
+
+    delta = chat_delta(ndjson_filename, user_chara_card_filename, shown_until)
+    user_name = prompt_registry.card_name(user_chara_card_filename)
+    now = datetime.now()
+    in_flight = {
+        "sender": prompt_registry.card_name(ai_chara_card_filename),
+        "content": "",
+        "date": now.strftime("%d/%m/%Y"),
+        "time": now.strftime("%H:%M"),
+    }
+    yield delta
+
+    stream = ollama_stream_message(
+        model_name,
+        ndjson_filename,
+        user_chara_card_filename,
+        ai_chara_card_filename,
+        sys_prompt_filename,
+        num_messages,
+        num_ctx,
+        num_predict,
+        options,
+        keep_alive,
+        use_memory,
+        use_summaries,
+        burst_epoch,
+    )
+    try:
+        for kind, value in stream:
+            if kind == "queued":
+                value = f"*Waiting for the model, #{value} in queue...*"
+            in_flight["content"] = value
+            yield {
+                **delta,
+                "messages": [*delta["messages"], format_history_entry(in_flight, user_name)],
+            }
+    except BackendBusy as e:
+        raise gr.Error(str(e))
+
+    yield chat_delta(ndjson_filename, user_chara_card_filename, shown_until)
+
+
+def prefill_chat(
+    model_name: str,
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filename: str,
+    sys_prompt_filename: str,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    use_memory: bool = False,
+    use_summaries: bool = False,
+    speculative_prefill: bool = False,
+    num_messages: int = 1000,
+):
+    """
+    Warm the model with the prompt the next reply will start with, see
+    Prefiller. Recalled memories are left out: they come after the history
+    and change with every message, so the reply's prompt still starts with
+    exactly these messages, and recalling them would cost an embedding
+    request per keystroke.
+    """
+    if not (
+        speculative_prefill
+        and model_name
+        and ndjson_filename
+        and user_chara_card_filename
+        and ai_chara_card_filename
+        and sys_prompt_filename
+    ):
+        return
+    prefiller.prefill(
+        model_name,
+        ndjson_filename,
+        lambda: build_chat_messages(
+            ndjson_filename,
+            user_chara_card_filename,
+            ai_chara_card_filename,
+            sys_prompt_filename,
+            num_messages,
+            num_ctx,
+            num_predict,
+            use_memory,
+            model_name if use_summaries else None,
+            recall_memory=False,
+        ),
+        generation_options(options, num_ctx, num_predict),
+        keep_alive,
+    )
+
+
+def send_unprompted_message(ndjson_filename: str, settings: dict) -> bool:
+    """
+    Have the AI write to a chat that has gone quiet, with the settings it was
+    armed with. Runs as a background job capped at num_predict tokens;
+    returns False if nothing was written because the backend was busy, the
+    job gave way to a reply somebody is waiting for or it was cancelled.
+    """
+    burst_epoch = burst_coalescer.current(ndjson_filename)
+    messages = build_chat_messages(
+        ndjson_filename,
+        settings["user_character"],
+        settings["ai_character"],
+        settings["system_prompt"],
+        settings["num_messages"],
+        settings["num_ctx"],
+        settings["num_predict"],
+        settings["use_memory"],
+        settings["model"] if settings["use_summaries"] else None,
+    )
+    messages.append(
+        {
+            "role": "system",
+            "content": autonomous_instructions.format(
+                ai=prompt_registry.card_name(settings["ai_character"]),
+                user=prompt_registry.card_name(settings["user_character"]),
+            ),
+        }
+    )
+    try:
+        job = backend_pool.submit(
+            settings["model"],
+            ndjson_filename,
+            messages,
+            generation_options(
+                settings["options"], settings["num_ctx"], settings["num_predict"]
+            ),
+            settings["keep_alive"],
+            background=True,
+        )
+        reply = job.result()
+    except BackendBusy:
+        # a full queue, or Preempted, which is a BackendBusy too
+        return False
+    if reply is None:
+        return False
+    # dropped if the user writes in the meantime, their message gets a reply instead
+    commit_reply(ndjson_filename, settings["ai_character"], reply, burst_epoch)
+    return True
+
+
+def refresh_open_chat(
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    autonomous_messages: bool,
+    chat_view: dict = None,
+):
+    if not autonomous_messages or not ndjson_filename or not user_chara_card_filename:
+        return gr.update()
+    delta = chat_delta(
+        ndjson_filename, user_chara_card_filename, shown_until(ndjson_filename, chat_view)
+    )
+    if delta["op"] == "replace" and not delta["messages"]:
+        return gr.update()
+    return delta
+
+
+def context_stats_report() -> str:
+    return summarizer.stats.report() + "\n" + prefiller.report()
+
+
+def send_and_reply(
+    content: str,
+    model_name: str,
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filename: str,
+    sys_prompt_filename: str,
+    stream_replies: bool = True,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    use_memory: bool = False,
+    use_summaries: bool = False,
+    quiet_period: float = default_quiet_period,
+    speculative_prefill: bool = False,
+    autonomous_messages: bool = False,
+    chat_view: dict = None,
+    num_messages: int = 1000,
+):
+    """
+    Submit handler: sends the user's message, then replies to it once the
+    user has been quiet for a bit. The burst epoch stays local to this call,
+    so overlapping submits can't mix up which one is the latest. The chatbox
+    only receives what was appended after the messages chat_view says it shows.
+    """
+    start = shown_until(ndjson_filename, chat_view)
+    burst_epoch = send_user_message(
+        ndjson_filename, user_chara_card_filename, content
+    )
+    if autonomous_messages:
+        autonomous_scheduler.arm(
+            ndjson_filename,
+            {
+                "model": model_name,
+                "user_character": user_chara_card_filename,
+                "ai_character": ai_chara_card_filename,
+                "system_prompt": sys_prompt_filename,
+                "num_messages": num_messages,
+                "num_ctx": num_ctx,
+                "num_predict": num_predict,
+                "options": options,
+                "keep_alive": keep_alive,
+                "use_memory": use_memory,
+                "use_summaries": use_summaries,
+            },
+        )
+    else:
+        autonomous_scheduler.disarm(ndjson_filename)
+    yield "", chat_delta(ndjson_filename, user_chara_card_filename, start)
+
+    for delta in stream_reply_into_chat(
+        model_name,
+        ndjson_filename,
+        user_chara_card_filename,
+        ai_chara_card_filename,
+        sys_prompt_filename,
+        stream_replies,
+        num_ctx,
+        num_predict,
+        options,
+        keep_alive,
+        use_memory,
+        use_summaries,
+        burst_epoch,
+        quiet_period,
+        num_messages,
+        start,
+    ):
+        yield gr.update(), delta
+
+    if burst_coalescer.is_current(ndjson_filename, burst_epoch):
+        # get the model ready for the user's next message
+        prefill_chat(
+            model_name,
+            ndjson_filename,
+            user_chara_card_filename,
+            ai_chara_card_filename,
+            sys_prompt_filename,
+            num_ctx,
+            num_predict,
+            options,
+            keep_alive,
+            use_memory,
+            use_summaries,
+            speculative_prefill,
+        )
+
+
+def shown_until(ndjson_filename: str, chat_view: dict = None) -> int:
+    """
+    Index just past the last saved message the chatbox shows, None if it
+    shows another chat or doesn't know where its messages start
+    """
+    if not chat_view or chat_view.get("chat") != ndjson_filename:
+        return None
+    if chat_view.get("first") is None:
+        return None
+    return chat_view["first"] + chat_view["count"]
+
+
+def chat_delta(
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    start: int = None,
+    page_size: int = chat_page_size,
+    wait_for_index: bool = False,
+) -> dict:
+    """
+    The chat's messages from index start on, for apply_chat_delta_js to put in
+    place of whatever the chatbox shows from there. If start is None or the
+    chatbox is too far behind, the last page is sent to replace it instead.
+    A chat opened for the first time is shown before its lines are counted,
+    with "first" set to None; the next delta then replaces the whole page.
+    """
+    with span("render_chat"):
+        first_index, history = load_chat_history_window(
+            ndjson_filename, user_chara_card_filename, page_size, wait_for_index
+        )
+    if (
+        start is None
+        or first_index is None
+        or not first_index <= start <= first_index + len(history)
+    ):
+        return {
+            "chat": ndjson_filename,
+            "op": "reset",
+            "first": first_index,
+            "messages": history,
+            "persisted": len(history),
+            "seq": next(_chat_delta_seq),
+        }
+    appended = history[start - first_index :]
+    return {
+        "chat": ndjson_filename,
+        "op": "replace",
+        "first": start,
+        "messages": appended,
+        "persisted": len(appended),
+        "seq": next(_chat_delta_seq),
+    }
+
+
+def show_chat_page(ndjson_filename: str, user_chara_card_filename: str):
+    if not ndjson_filename or not user_chara_card_filename:
+        return gr.update()
+    return chat_delta(ndjson_filename, user_chara_card_filename)
+
+
+def load_older_messages(
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    chat_view: dict = None,
+):
+    """The page of messages before the oldest one the chatbox shows"""
+    if not chat_view or chat_view.get("chat") != ndjson_filename:
+        return gr.update()
+    if chat_view.get("first") is None:
+        # the chat was shown before its lines were counted, so send a bigger last page
+        return chat_delta(
+            ndjson_filename,
+            user_chara_card_filename,
+            page_size=chat_view["count"] + chat_page_size,
+            wait_for_index=True,
+        )
+    if chat_view["first"] == 0:
+        return gr.update()
+    stop = chat_view["first"]
+    start = max(stop - chat_page_size, 0)
+    user_name = prompt_registry.card_name(user_chara_card_filename)
+    with span("render_chat"):
+        older = [
+            format_history_entry(entry, user_name)
+            for entry in load_ndjson_range(ndjson_filename, start, stop)
+        ]
+    return {
+        "chat": ndjson_filename,
+        "op": "prepend",
+        "first": start,
+        "messages": older,
+        "persisted": len(older),
+        "seq": next(_chat_delta_seq),
+    }
 
 
 def render_chat(
@@ -140,11 +1001,223 @@ def render_chat(
     user_chara_card_filename,
     last_n_messages_to_render: int = 1000,
 ):
-    chat_path = os.path.join(chats_filepath, ndjson_filename)
-    in_mem = load_ndjson_into_memory(ndjson_filename, last_n_messages_to_render)
-    cleaned = sanitize_loaded_ndjson_into_history(in_mem, user_chara_card_filename)
-    return cleaned
+    with span("render_chat"):
+        return load_chat_history(
+            ndjson_filename, user_chara_card_filename, last_n_messages_to_render
+        )
+
+
+def run_group_round(
+    model_name: str,
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filenames: list[str],
+    sys_prompt_filename: str,
+    speakers_per_round: int = default_speakers_per_round,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    chat_view: dict = None,
+    num_messages: int = 1000,
+):
+    """
+    Event handler for one round of a group chat. The chat is formatted and
+    packed into the context once, then every chosen speaker gets their own
+    view of it and generates in parallel on the backend pool. Replies are
+    written in the order the speakers were chosen, whichever finishes first.
+    Yields chat deltas like stream_reply_into_chat, only when a reply grows
+    or gets written.
+    """
+    if not ai_chara_card_filenames:
+        raise gr.Error("Pick at least one AI character.")
+    cards_by_name = {
+        prompt_registry.card_name(card): card for card in ai_chara_card_filenames
+    }
+
+    entries = load_ndjson_into_memory(ndjson_filename, num_messages)
+    first_index = count_chat_messages(ndjson_filename) - len(entries)
+    speakers = choose_speakers(entries, list(cards_by_name), int(speakers_per_round))
+    if not speakers:
+        return
 
+    system_msgs = {
+        name: {
+            "role": "system",
+            "content": prompt_registry.group_system_message(
+                sys_prompt_filename,
+                cards_by_name[name],
+                user_chara_card_filename,
+                ai_chara_card_filenames,
+            ),
+        }
+        for name in speakers
+    }
+    longest_system_msg = max(system_msgs.values(), key=count_message_tokens)
+    packed = build_context(
+        longest_system_msg,
+        shared_history(entries),
+        first_index,
+        num_ctx - num_predict,
+    )[1:]
+
+    jobs = []
+    for name in speakers:
+        messages = [system_msgs[name], *participant_view(packed, name)]
+        jobs.append(
+            backend_pool.submit(
+                model_name,
+                f"{ndjson_filename}#{cards_by_name[name]}",
+                messages,
+                generation_options(options, num_ctx, num_predict),
+                keep_alive,
+            )
+        )
+
+    results = {}
+
+    def collect(index, job):
+        try:
+            results[index] = job.result()
+        except Exception as e:
+            results[index] = e
+
+    for index, job in enumerate(jobs):
+        threading.Thread(target=collect, args=(index, job), daemon=True).start()
+
+    start = shown_until(ndjson_filename, chat_view)
+    user_name = prompt_registry.card_name(user_chara_card_filename)
+    committed = 0
+    delta = None
+    shown = None
+    try:
+        while committed < len(speakers):
+            while committed in results:
+                reply = results[committed]
+                if isinstance(reply, Exception):
+                    gr.Warning(f"{speakers[committed]} could not reply: {reply}")
+                else:
+                    sanitize_and_send_message(
+                        ndjson_filename, cards_by_name[speakers[committed]], reply
+                    )
+                committed += 1
+            # the chat is only read again once a reply has been written to it
+            if delta is None or shown[0] != committed:
+                delta = chat_delta(ndjson_filename, user_chara_card_filename, start)
+            texts = [job.text for job in jobs[committed:]]
+            if shown != (committed, texts):
+                shown = (committed, texts)
+                now = datetime.now()
+                in_flight = [
+                    format_history_entry(
+                        {
+                            "sender": name,
+                            "content": text or "*typing...*",
+                            "date": now.strftime("%d/%m/%Y"),
+                            "time": now.strftime("%H:%M"),
+                        },
+                        user_name,
+                    )
+                    for name, text in zip(speakers[committed:], texts)
+                ]
+                yield {**delta, "messages": [*delta["messages"], *in_flight]}
+            if committed < len(speakers):
+                time.sleep(group_poll_seconds)
+    finally:
+        for job in jobs[committed:]:
+            job.cancel()
+
+
+def send_and_run_group_round(
+    content: str,
+    model_name: str,
+    ndjson_filename: str,
+    user_chara_card_filename: str,
+    ai_chara_card_filenames: list[str],
+    sys_prompt_filename: str,
+    speakers_per_round: int = default_speakers_per_round,
+    num_ctx: int = 2048,
+    num_predict: int = 128,
+    options: dict = None,
+    keep_alive: str = default_keep_alive,
+    chat_view: dict = None,
+):
+    start = shown_until(ndjson_filename, chat_view)
+    sanitize_and_send_message(ndjson_filename, user_chara_card_filename, content)
+    yield "", chat_delta(ndjson_filename, user_chara_card_filename, start)
+    for delta in run_group_round(
+        model_name,
+        ndjson_filename,
+        user_chara_card_filename,
+        ai_chara_card_filenames,
+        sys_prompt_filename,
+        speakers_per_round,
+        num_ctx,
+        num_predict,
+        options,
+        keep_alive,
+        chat_view,
+    ):
+        yield gr.update(), delta
+
+
+def parse_search_date(date_str: str, days_after: int = 0) -> int:
+    if not date_str or not date_str.strip():
+        return None
+    try:
+        return to_timestamp(date_str.strip(), "00:00") + days_after * 86400
+    except ValueError:
+        raise gr.Error(f"{date_str} is not a date like 19/04/2025.")
+
+
+def search_chats(
+    query: str,
+    date_from: str,
+    date_to: str,
+    chat_filenames: list[str] = None,
+):
+    """Search handler: the newest matching messages and how long the lookup took"""
+    started = time.perf_counter()
+    hits, total = search_index.search(
+        query,
+        parse_search_date(date_from),
+        # the end date is inclusive
+        parse_search_date(date_to, days_after=1),
+        chat_filenames,
+    )
+    elapsed = time.perf_counter() - started
+
+    rows = []
+    for chat_filename, index, _ in hits:
+        for entry in load_ndjson_range(chat_filename, index, index + 1):
+            rows.append(
+                [chat_filename, entry["date"], entry["time"], entry["sender"], entry["content"]]
+            )
+    status = f"{total} messages found in {elapsed * 1000:.1f} ms"
+    if total > len(rows):
+        status += f", showing the newest {len(rows)}"
+    if not search_index.ready.is_set():
+        status += " (still indexing, results may be incomplete)"
+    return rows, status
+
+
+memory_manager = MemoryManager(
+    load_ndjson_range, count_chat_messages, backend_embedder(backend_pool.embed)
+)
+search_index = SearchIndex(
+    load_ndjson_range, count_chat_messages, chat_size, list_chats
+)
+summarizer = Summarizer(
+    load_ndjson_range, backend_pool.generate_text, backend_pool.is_idle
+)
+autonomous_scheduler = AutonomousScheduler(
+    lambda chat: next(
+        (entry for entry in load_ndjson_into_memory(chat, 1) if not entry.get("unreadable")),
+        None,
+    ),
+    send_unprompted_message,
+    backend_pool.is_idle,
+)
 
 # https://huggingface.co/spaces/gradio/theme-gallery
 
@@ -156,14 +1229,14 @@ with gr.Blocks(
             with gr.Row():
                 with gr.Column(scale=1):
                     model_name = gr.Dropdown(
-                        choices=list_ollama_models(),
+                        choices=[],
                         label="Model Editor",
                         info="Select the Ollama model to use. Heavier models are recommended for both quality and more realistic speed (slower).",
                         interactive=True,
                     )
                     with gr.Column():
                         model_template = gr.Dropdown(
-                            choices=list_files_in_filepath(model_templates_filepath),
+                            choices=[],
                             label="Load Template",
                             info='Select to load a saved template for a model to use. Make sure to check the "Override Defaults" button in the bottom right for the changes to take effect.',
                             interactive=True,
@@ -292,55 +1365,84 @@ with gr.Blocks(
                             interactive=True,
                         )
                     with gr.Column():
-                        gr.Checkbox(
+                        keep_alive = gr.Textbox(
+                            value=default_keep_alive,
+                            label="Keep Alive",
+                            info='How long Ollama keeps the model loaded after a message, e.g. "30m", "2h", "-1m" or -1 for forever, 0 to unload right away. Longer values avoid reloading the model between messages.',
+                            interactive=True,
+                        )
+                        override_defaults = gr.Checkbox(
                             label="Override Defaults",
                             info="Check this box to override defaults with the changes above. Otherwise, Ollama model file defaults will be used instead. Recommended to keep this off unless you know what you are doing.",
                         )
+            model_options = gr.State({})
+            model_option_sliders = [
+                temperature,
+                top_p,
+                top_k,
+                tfc_z,
+                mirostat,
+                mirostat_tau,
+                mirostat_eta,
+                num_predict,
+                num_ctx,
+                repeat_last_n,
+                repeat_penalty,
+            ]
 
         with gr.Tab("Character Card Editor"):
             with gr.Row():
                 with gr.Column(scale=1):
-                    gr.Dropdown(
-                        choices=list_files_in_filepath(character_cards_filepath),
+                    card_editor_file = gr.Dropdown(
+                        choices=[],
                         label="Load",
                         info="Select the character card to load and modify it.",
                         interactive=True,
                     )
                     with gr.Column():
-                        gr.Textbox(
+                        card_editor_filename = gr.Textbox(
                             label="Filename",
                             info="Filename for the character card. This is how the character card is/will be saved/deleted in the characters/character_cards/ folder.",
                             interactive=True,
                         )
-                        gr.Button(value="Save Character Card", interactive=True)
-                        gr.Button(value="Delete Character Card", interactive=True)
+                        save_card = gr.Button(
+                            value="Save Character Card", interactive=True
+                        )
+                        delete_card = gr.Button(
+                            value="Delete Character Card", interactive=True
+                        )
 
                 with gr.Column(scale=3):
-                    gr.TextArea(
+                    card_editor_text = gr.TextArea(
                         label="Character Card",
                         info="The raw yaml file of the character card. replAI pulls data from these character cards to instantiate characters (instances of the Character class) and then uses these class instances later in the system prompt. Recommended to not modify this much (for now), unless if you are willing to dig in some extra code.",
+                        interactive=True,
                     )
 
         with gr.Tab("System Prompt Editor"):
             with gr.Row():
                 with gr.Column(scale=1):
-                    gr.Dropdown(
-                        choices=list_files_in_filepath(sys_prompts_filepath),
+                    prompt_editor_file = gr.Dropdown(
+                        choices=[],
                         label="Load",
                         info="Select the system prompt to load and modify it.",
                         interactive=True,
                     )
                     with gr.Column():
-                        gr.Textbox(
+                        prompt_editor_filename = gr.Textbox(
                             label="Filename",
                             info="Filename for the system prompt. This is how the system prompt is/will be saved/deleted in the system_prompts/ folder.",
                             interactive=True,
                         )
-                        gr.Button(value="Save System Prompt", interactive=True)
-                        gr.Button(value="Delete System Prompt", interactive=True)
+                        save_prompt = gr.Button(
+                            value="Save System Prompt", interactive=True
+                        )
+                        delete_prompt = gr.Button(
+                            value="Delete System Prompt", interactive=True
+                        )
 
                 with gr.Column(scale=3):
-                    gr.TextArea(
+                    prompt_editor_text = gr.TextArea(
                         label="System Prompt",
                         info="The raw python file of the system prompt. replAI pulls attributes from characters (instances of the Character class) and uses them for the system prompt. Recommended to not modify this much (for now), unless if you are willing to dig in some extra code.",
                         interactive=True,
@@ -351,7 +1453,7 @@ with gr.Blocks(
                 with gr.Column(scale=1):
                     with gr.Column():
                         current_chat = gr.Dropdown(
-                            choices=list_files_in_filepath(chats_filepath),
+                            choices=[],
                             label="Load",
                             info="Load an existing chat.",
                             interactive=True,
@@ -366,13 +1468,67 @@ with gr.Blocks(
                         gr.Button(value="Delete Selected Chat", interactive=True)
                     with gr.Column():
                         ollama_model = gr.Dropdown(
-                            choices=list_ollama_models(),
+                            choices=[],
                             label="Load Model",
                             info="Select the model to use.",
                             interactive=True,
                         )
+                        refresh_models = gr.Button(
+                            value="Refresh Models", interactive=True
+                        )
+                        stream_replies = gr.Checkbox(
+                            value=True,
+                            label="Stream Replies",
+                            info="Show the AI's message as it is being typed. The message is only saved to the chat once it is complete.",
+                        )
+                        use_memory = gr.Checkbox(
+                            value=False,
+                            label="Long-term Memory",
+                            info="Remind the AI of older messages related to the conversation, found by embedding the chat with an embedding model on the configured servers. The chat is embedded in the background once this is on.",
+                        )
+                        use_summaries = gr.Checkbox(
+                            value=False,
+                            label="Summarize Old Messages",
+                            info="Give the AI summaries of the messages that no longer fit in its context. Summaries are written in the background while the model is idle and cached in cache/summaries/.",
+                        )
+                        quiet_period = gr.Slider(
+                            minimum=0.0,
+                            maximum=10.0,
+                            step=0.5,
+                            value=default_quiet_period,
+                            label="Reply Delay",
+                            info="Seconds the AI waits after your last message before replying, so several messages in a row get one reply.",
+                            interactive=True,
+                        )
+                        speculative_prefill = gr.Checkbox(
+                            value=False,
+                            label="Prefill While Typing",
+                            info="While you type, have the model read the chat ahead of time so its reply starts sooner. Uses the model while it is otherwise idle.",
+                        )
+                        autonomous_messages = gr.Checkbox(
+                            value=False,
+                            label="AI Starts Conversations",
+                            info="Let the AI write first when this chat has been quiet for a while, outside of night hours and only once until you answer. Takes effect with your next message.",
+                        )
+                        autonomous_refresh = gr.Timer(autonomous_refresh_seconds)
+                        with gr.Accordion("Context Stats", open=False):
+                            context_stats = gr.Textbox(
+                                show_label=False,
+                                lines=6,
+                                interactive=False,
+                                placeholder="Prompt sizes, prefill times and time to first token.",
+                            )
+                            refresh_context_stats = gr.Button(
+                                value="Refresh Stats", interactive=True
+                            )
 
                 with gr.Column(scale=2):
+                    load_older = gr.Button(
+                        value="Load Older Messages", size="sm", interactive=True
+                    )
+                    # what the chatbox shows, kept by apply_chat_delta_js in the browser
+                    chat_view = gr.JSON(value=None, visible="hidden")
+                    chat_delta_box = gr.JSON(value=None, visible="hidden")
                     with gr.Group():
                         chatbox = gr.Chatbot(
                             elem_id="chatbox",
@@ -397,7 +1553,7 @@ with gr.Blocks(
                 with gr.Column(scale=1):
                     with gr.Column():
                         user_character = gr.Dropdown(
-                            choices=list_files_in_filepath(character_cards_filepath),
+                            choices=[],
                             label="User Character",
                             info="Select the character you will be roleplaying.",
                             interactive=True,
@@ -410,7 +1566,7 @@ with gr.Blocks(
                             interactive=False,
                         )
                         ai_character = gr.Dropdown(
-                            choices=list_files_in_filepath(character_cards_filepath),
+                            choices=[],
                             label="AI Character",
                             info="Select the character that the AI will be roleplaying.",
                             interactive=True,
@@ -424,7 +1580,7 @@ with gr.Blocks(
                         )
                     with gr.Column():
                         system_prompt = gr.Dropdown(
-                            choices=list_files_in_filepath(sys_prompts_filepath),
+                            choices=[],
                             label="System Prompt",
                             info="Select the system prompt that the AI will use.",
                             interactive=True,
@@ -437,21 +1593,191 @@ with gr.Blocks(
                             interactive=False,
                         )
 
+        with gr.Tab("Group Chat"):
+            with gr.Row():
+                with gr.Column(scale=1):
+                    with gr.Column():
+                        group_chat = gr.Dropdown(
+                            choices=[],
+                            label="Load",
+                            info="Load an existing chat to use as a group channel.",
+                            interactive=True,
+                        )
+                    with gr.Column():
+                        group_model = gr.Dropdown(
+                            choices=[],
+                            label="Load Model",
+                            info="Select the model every AI in the group will use.",
+                            interactive=True,
+                        )
+                        group_speakers = gr.Slider(
+                            minimum=1,
+                            maximum=5,
+                            step=1,
+                            value=default_speakers_per_round,
+                            label="Speakers Per Round",
+                            info="How many AIs may answer each message. AIs mentioned by name answer first, otherwise those who have been quiet the longest.",
+                            interactive=True,
+                        )
+
+                with gr.Column(scale=2):
+                    group_load_older = gr.Button(
+                        value="Load Older Messages", size="sm", interactive=True
+                    )
+                    # what the group chatbox shows, kept by apply_chat_delta_js in the browser
+                    group_chat_view = gr.JSON(value=None, visible="hidden")
+                    group_chat_delta_box = gr.JSON(value=None, visible="hidden")
+                    with gr.Group():
+                        group_chatbox = gr.Chatbot(
+                            elem_id="group_chatbox",
+                            label=None,
+                            value=None,
+                            show_label=False,
+                            placeholder="The group chat history will appear here.",
+                            type="messages",
+                            resizable=True,
+                            show_copy_button=True,
+                            layout="bubble",
+                            group_consecutive_messages=False,
+                        )
+                        group_message = gr.Textbox(
+                            elem_id="group_message",
+                            show_label=False,
+                            placeholder="Type your message here...",
+                            container=True,
+                            submit_btn=False,
+                        )
+                    group_continue = gr.Button(value="Let Them Talk", interactive=True)
+
+                with gr.Column(scale=1):
+                    with gr.Column():
+                        group_user_character = gr.Dropdown(
+                            choices=[],
+                            label="User Character",
+                            info="Select the character you will be roleplaying.",
+                            interactive=True,
+                        )
+                        group_ai_characters = gr.Dropdown(
+                            choices=[],
+                            multiselect=True,
+                            label="AI Characters",
+                            info="Select the characters the AIs will be roleplaying.",
+                            interactive=True,
+                        )
+                    with gr.Column():
+                        group_system_prompt = gr.Dropdown(
+                            choices=[],
+                            label="System Prompt",
+                            info="Select the system prompt every AI will use. group_chat.tpl is written for groups.",
+                            interactive=True,
+                        )
+
+        with gr.Tab("Search"):
+            with gr.Row():
+                search_query = gr.Textbox(
+                    label="Search",
+                    placeholder="Words to look for in every chat...",
+                    scale=3,
+                )
+                search_date_from = gr.Textbox(
+                    label="From", placeholder="dd/mm/YYYY", scale=1
+                )
+                search_date_to = gr.Textbox(
+                    label="To", placeholder="dd/mm/YYYY", scale=1
+                )
+                search_chat_filter = gr.Dropdown(
+                    choices=[],
+                    multiselect=True,
+                    label="Chats",
+                    info="Leave empty to search all chats.",
+                    interactive=True,
+                    scale=2,
+                )
+            search_button = gr.Button(value="Search", interactive=True)
+            search_status = gr.Markdown()
+            search_results = gr.Dataframe(
+                headers=["Chat", "Date", "Time", "Sender", "Message"],
+                interactive=False,
+                wrap=True,
+            )
+
+    gr.on(
+        triggers=[override_defaults.change]
+        + [slider.change for slider in model_option_sliders],
+        fn=build_model_options,
+        inputs=[override_defaults, *model_option_sliders],
+        outputs=model_options,
+    )
+    model_template.select(
+        fn=load_model_template,
+        inputs=model_template,
+        outputs=[model_template_filename, model_name, *model_option_sliders],
+    )
+    save_model_template.click(
+        fn=write_model_template,
+        inputs=[model_template_filename, model_name, *model_option_sliders],
+        outputs=model_template,
+    )
+    delete_model_template.click(
+        fn=remove_model_template,
+        inputs=model_template_filename,
+        outputs=model_template,
+    )
+    ollama_model.select(fn=warm_up_model, inputs=[ollama_model, keep_alive])
+
+    card_editor_file.select(
+        fn=lambda f: (f, load_and_display_file(character_cards_filepath, f)),
+        inputs=card_editor_file,
+        outputs=[card_editor_filename, card_editor_text],
+    )
+    save_card.click(
+        fn=lambda f, text: save_file(character_cards_filepath, f, text),
+        inputs=[card_editor_filename, card_editor_text],
+        outputs=card_editor_file,
+    )
+    delete_card.click(
+        fn=lambda f: delete_file(character_cards_filepath, f),
+        inputs=card_editor_filename,
+        outputs=[card_editor_file, card_editor_text],
+    )
+
+    prompt_editor_file.select(
+        fn=lambda f: (f, load_and_display_file(sys_prompts_filepath, f)),
+        inputs=prompt_editor_file,
+        outputs=[prompt_editor_filename, prompt_editor_text],
+    )
+    save_prompt.click(
+        fn=lambda f, text: save_file(sys_prompts_filepath, f, text),
+        inputs=[prompt_editor_filename, prompt_editor_text],
+        outputs=prompt_editor_file,
+    )
+    delete_prompt.click(
+        fn=lambda f: delete_file(sys_prompts_filepath, f),
+        inputs=prompt_editor_filename,
+        outputs=[prompt_editor_file, prompt_editor_text],
+    )
+
     current_chat.select(
         fn=lambda x: x, inputs=current_chat, outputs=current_chat_filename
-    ).then(fn=render_chat, inputs=[current_chat, user_character], outputs=chatbox)
+    ).then(
+        fn=show_chat_page, inputs=[current_chat, user_character], outputs=chat_delta_box
+    )
 
     user_character.select(
         fn=lambda f: load_and_display_file(character_cards_filepath, f),
         inputs=user_character,
         outputs=user_character_description,
-    ).then(fn=render_chat, inputs=[current_chat, user_character], outputs=chatbox)
+    ).then(
+        fn=show_chat_page, inputs=[current_chat, user_character], outputs=chat_delta_box
+    )
 
     ai_character.select(
         fn=lambda f: load_and_display_file(character_cards_filepath, f),
         inputs=ai_character,
         outputs=ai_character_description,
-    ).then(fn=render_chat, inputs=[current_chat, user_character], outputs=chatbox)
+    ).then(
+        fn=show_chat_page, inputs=[current_chat, user_character], outputs=chat_delta_box
+    )
 
     system_prompt.select(
         fn=lambda f: load_and_display_file(sys_prompts_filepath, f),
@@ -459,40 +1785,72 @@ with gr.Blocks(
         outputs=system_prompt_description,
     )
 
-    user_message.submit(
-        fn=sanitize_and_send_message,
-        inputs=[current_chat, user_character, user_message],
-        outputs=None,
-    ).then(
-        fn=lambda: "",
-        inputs=None,
-        outputs=user_message,
-    ).then(
-        fn=render_chat,
-        inputs=[current_chat, user_character],
-        outputs=chatbox,
-    ).then(
-        fn=lambda a, b, c, d, e: ollama_generate_message(
-            model_name=a,
-            ndjson_filename=b,
-            user_chara_card_filename=c,
-            ai_chara_card_filename=d,
-            sys_prompt_filename=e,
-            num_messages=1000,
-        ),
+    # every message goes through, even while a reply is still being generated
+    reply_event = user_message.submit(
+        fn=send_and_reply,
         inputs=[
+            user_message,
             ollama_model,
             current_chat,
             user_character,
             ai_character,
             system_prompt,
+            stream_replies,
+            num_ctx,
+            num_predict,
+            model_options,
+            keep_alive,
+            use_memory,
+            use_summaries,
+            quiet_period,
+            speculative_prefill,
+            autonomous_messages,
+            chat_view,
+        ],
+        outputs=[user_message, chat_delta_box],
+        trigger_mode="multiple",
+    )
+    autonomous_refresh.tick(
+        fn=refresh_open_chat,
+        inputs=[current_chat, user_character, autonomous_messages, chat_view],
+        outputs=chat_delta_box,
+        show_progress="hidden",
+    )
+    user_message.input(
+        fn=prefill_chat,
+        inputs=[
+            ollama_model,
+            current_chat,
+            user_character,
+            ai_character,
+            system_prompt,
+            num_ctx,
+            num_predict,
+            model_options,
+            keep_alive,
+            use_memory,
+            use_summaries,
+            speculative_prefill,
         ],
         outputs=None,
-    ).then(
-        fn=render_chat,
-        inputs=[current_chat, user_character],
-        outputs=chatbox,
+        trigger_mode="always_last",
+        show_progress="hidden",
+    )
+
+    chat_delta_box.change(
+        fn=None,
+        inputs=[chatbox, chat_view, chat_delta_box],
+        outputs=[chatbox, chat_view],
+        js=apply_chat_delta_js,
     )
+    load_older.click(
+        fn=load_older_messages,
+        inputs=[current_chat, user_character, chat_view],
+        outputs=chat_delta_box,
+    )
+
+    # switching chats abandons the reply being streamed into the old one
+    current_chat.select(fn=None, inputs=None, outputs=None, cancels=[reply_event])
 
     demo.load(
         fn=lambda: (
@@ -513,7 +1871,7 @@ with gr.Blocks(
                 else None
             ),
             (
-                render_chat(current_chat.value, user_character.value)
+                chat_delta(current_chat.value, user_character.value)
                 if current_chat.value and user_character.value
                 else None
             ),
@@ -523,8 +1881,89 @@ with gr.Blocks(
             user_character_description,
             ai_character_description,
             system_prompt_description,
-            chatbox,
+            chat_delta_box,
         ],
     )
 
-demo.launch(favicon_path="misc/replAI_favicon_rounded.ico")
+    demo.load(
+        fn=populate_dropdowns,
+        outputs=[
+            model_name,
+            model_template,
+            card_editor_file,
+            prompt_editor_file,
+            current_chat,
+            ollama_model,
+            user_character,
+            ai_character,
+            system_prompt,
+            group_chat,
+            group_model,
+            group_user_character,
+            group_ai_characters,
+            group_system_prompt,
+            search_chat_filter,
+        ],
+    )
+    refresh_context_stats.click(fn=context_stats_report, outputs=context_stats)
+    refresh_models.click(
+        fn=refresh_model_dropdowns, outputs=[model_name, ollama_model, group_model]
+    )
+
+    gr.on(
+        triggers=[search_query.submit, search_button.click],
+        fn=search_chats,
+        inputs=[search_query, search_date_from, search_date_to, search_chat_filter],
+        outputs=[search_results, search_status],
+    )
+
+    group_round_inputs = [
+        group_model,
+        group_chat,
+        group_user_character,
+        group_ai_characters,
+        group_system_prompt,
+        group_speakers,
+        num_ctx,
+        num_predict,
+        model_options,
+        keep_alive,
+        group_chat_view,
+    ]
+    group_chat.select(
+        fn=show_chat_page,
+        inputs=[group_chat, group_user_character],
+        outputs=group_chat_delta_box,
+    )
+    group_user_character.select(
+        fn=show_chat_page,
+        inputs=[group_chat, group_user_character],
+        outputs=group_chat_delta_box,
+    )
+    group_chat_delta_box.change(
+        fn=None,
+        inputs=[group_chatbox, group_chat_view, group_chat_delta_box],
+        outputs=[group_chatbox, group_chat_view],
+        js=apply_chat_delta_js,
+    )
+    group_load_older.click(
+        fn=load_older_messages,
+        inputs=[group_chat, group_user_character, group_chat_view],
+        outputs=group_chat_delta_box,
+    )
+    group_message_event = group_message.submit(
+        fn=send_and_run_group_round,
+        inputs=[group_message, *group_round_inputs],
+        outputs=[group_message, group_chat_delta_box],
+    )
+    group_continue_event = group_continue.click(
+        fn=run_group_round, inputs=group_round_inputs, outputs=group_chat_delta_box
+    )
+    group_chat.select(
+        fn=None,
+        inputs=None,
+        outputs=None,
+        cancels=[group_message_event, group_continue_event],
+    )
+
+demo.queue(default_concurrency_limit=16)
@@ -0,0 +1,67 @@
+import re
+
+from chat_cache import format_history_entry, unreadable_content
+
+# how many AIs may answer the same message at once
+default_speakers_per_round = 2
+
+
+def choose_speakers(
+    entries: list[dict],
+    ai_names: list[str],
+    max_speakers: int = default_speakers_per_round,
+) -> list[str]:
+    """
+    Decide who speaks next in a group chat. AIs mentioned by name in the last
+    message answer first; otherwise the ones who have been quiet the longest
+    do. Whoever sent the last message never answers themselves. The result
+    only depends on the chat, so the same history always gives the same turn.
+    """
+    last = entries[-1] if entries else None
+    candidates = [name for name in ai_names if last is None or name != last["sender"]]
+    if not candidates:
+        return []
+
+    if last is not None:
+        mentioned = [
+            name
+            for name in candidates
+            if re.search(rf"\b{re.escape(name)}\b", last["content"], re.IGNORECASE)
+        ]
+        if mentioned:
+            return mentioned[:max_speakers]
+
+    last_spoke = {}
+    for index, entry in enumerate(entries):
+        last_spoke[entry["sender"]] = index
+    order = sorted(
+        candidates, key=lambda name: (last_spoke.get(name, -1), ai_names.index(name))
+    )
+    return order[:max_speakers]
+
+
+def participant_view(shared_history: list[dict], speaker_name: str) -> list[dict]:
+    """
+    One participant's view of the chat: their own messages are the assistant's,
+    everyone else's are the user's. The message contents are shared with every
+    other view, only the role differs.
+    """
+    return [
+        {
+            "role": "assistant" if message["sender"] == speaker_name else "user",
+            "content": message["content"],
+        }
+        for message in shared_history
+        if message["content"] != unreadable_content
+    ]
+
+
+def shared_history(entries: list[dict]) -> list[dict]:
+    """Format the chat once for all participants, keeping the sender for participant_view"""
+    return [
+        {
+            "sender": entry["sender"],
+            "content": format_history_entry(entry, None)["content"],
+        }
+        for entry in entries
+    ]
@@ -1 +1,24 @@
-import gradio_layout
\ No newline at end of file
+import time
+
+startup_start = time.perf_counter()
+
+import gradio_layout
+import metrics
+
+layout_built = time.perf_counter()
+gradio_layout.demo.launch(
+    favicon_path="misc/replAI_favicon_rounded.ico", prevent_thread_lock=True
+)
+launched = time.perf_counter()
+metrics.trace_log_filepath = gradio_layout.trace_log_filepath
+if gradio_layout.metrics_port:
+    try:
+        metrics.start_metrics_server(gradio_layout.metrics_port)
+        print(f"Metrics at http://127.0.0.1:{gradio_layout.metrics_port}/metrics")
+    except OSError as e:
+        print(f"Could not serve metrics on port {gradio_layout.metrics_port}: {e}")
+print(
+    f"replAI started in {launched - startup_start:.3f}s "
+    f"(layout {layout_built - startup_start:.3f}s, launch {launched - layout_built:.3f}s)"
+)
+gradio_layout.demo.block_thread()
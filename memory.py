@@ -0,0 +1,250 @@
+import os
+import json
+import queue
+import threading
+
+import numpy as np
+
+memory_filepath = os.path.join("cache", "memory")
+
+default_embedding_model = "nomic-embed-text"
+# messages embedded per request while catching up on a chat
+embed_batch_size = 64
+# chats with more embedded messages than this are searched through an IVF index
+ivf_threshold = 50000
+ivf_probes = 8
+
+
+def backend_embedder(embed, model: str = default_embedding_model):
+    """An embedder over embed(model, texts), such as BackendPool.embed"""
+
+    def embedder(texts: list[str]) -> np.ndarray:
+        return np.asarray(embed(model, texts), dtype=np.float32)
+
+    # the name predates other backends; it is kept so stored embeddings stay valid
+    embedder.name = f"ollama:{model}"
+    return embedder
+
+
+def entry_text(entry: dict) -> str:
+    return f"{entry['sender']}: {entry['content']}"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class IvfIndex:
+    """Coarse k-means partition of the vectors, so a query only scans a few clusters"""
+
+    def __init__(self, vectors: np.ndarray, iterations: int = 8, seed: int = 0):
+        self.size = len(vectors)
+        n_lists = max(int(np.sqrt(self.size)), 1)
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(self.size, min(self.size, n_lists * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignment == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = _normalize(centroids)
+        self.centroids = centroids
+        assignment = np.empty(self.size, dtype=np.int64)
+        for start in range(0, self.size, 65536):
+            block = vectors[start : start + 65536]
+            assignment[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+        self.lists = [order[bounds[c] : bounds[c + 1]] for c in range(n_lists)]
+
+    def candidates(self, query: np.ndarray, probes: int) -> np.ndarray:
+        nearest = np.argsort(self.centroids @ query)[::-1][:probes]
+        return np.concatenate([self.lists[c] for c in nearest])
+
+
+class ChatMemory:
+    """
+    Embeddings of every message in one chat, row i being message i, kept as a
+    float32 matrix on disk that is memory-mapped for search and only ever
+    appended to.
+    """
+
+    def __init__(self, chat_filename: str, embedder_name: str):
+        safe_name = chat_filename.replace(os.sep, "_")
+        self.matrix_path = os.path.join(memory_filepath, safe_name + ".f32")
+        self.meta_path = os.path.join(memory_filepath, safe_name + ".json")
+        self.embedder_name = embedder_name
+        self.dim = None
+        self.ivf = None
+        self.lock = threading.Lock()
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("embedder") == embedder_name:
+                self.dim = meta["dim"]
+        except (FileNotFoundError, ValueError):
+            pass
+        if self.dim is None and os.path.exists(self.matrix_path):
+            os.remove(self.matrix_path)
+
+    def count(self) -> int:
+        if self.dim is None or not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (4 * self.dim)
+
+    def append(self, vectors: np.ndarray):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        with self.lock:
+            if self.dim is None:
+                os.makedirs(memory_filepath, exist_ok=True)
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"embedder": self.embedder_name, "dim": self.dim}, f)
+            with open(self.matrix_path, "ab") as f:
+                f.write(vectors.tobytes())
+
+    def matrix(self) -> np.ndarray:
+        count = self.count()
+        if not count:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(
+            self.matrix_path, dtype=np.float32, mode="r", shape=(count, self.dim)
+        )
+
+    def update_ivf(self):
+        """
+        Build the IVF index once the chat is big enough, and again whenever it
+        has doubled since the last build. Slow, so only called from the
+        background thread, never while replying.
+        """
+        count = self.count()
+        with self.lock:
+            ivf = self.ivf
+        if count <= ivf_threshold or (ivf is not None and count <= 2 * ivf.size):
+            return
+        ivf = IvfIndex(np.asarray(self.matrix()))
+        with self.lock:
+            self.ivf = ivf
+
+    def search(self, query: np.ndarray, k: int, before: int) -> list[tuple[int, float]]:
+        """Top-k (message index, cosine similarity) among messages [0, before)"""
+        vectors = self.matrix()[:before]
+        if not len(vectors):
+            return []
+        query = _normalize(np.asarray(query, dtype=np.float32))
+
+        with self.lock:
+            ivf = self.ivf
+        if ivf is not None and len(vectors) > ivf_threshold:
+            candidates = ivf.candidates(query, ivf_probes)
+            # what was embedded since the index was built isn't in it, so it is scanned in full
+            candidates = np.sort(
+                np.concatenate(
+                    [candidates, np.arange(ivf.size, len(vectors), dtype=candidates.dtype)]
+                )
+            )
+            candidates = candidates[candidates < len(vectors)]
+            if not len(candidates):
+                return []
+            scores = vectors[candidates] @ query
+        else:
+            candidates = None
+            scores = vectors @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        indices = top if candidates is None else candidates[top]
+        return [(int(i), float(scores[t])) for i, t in zip(indices, top)]
+
+
+class MemoryManager:
+    """
+    Embeds chat messages in a background thread as they are appended, and
+    finds the earlier messages most relevant to the current conversation.
+    load_range(chat_filename, start, stop) and count_messages(chat_filename)
+    read the chat, so any storage backend can be used, and embedder(texts)
+    returns their vectors, see backend_embedder.
+    """
+
+    def __init__(self, load_range, count_messages, embedder):
+        self.load_range = load_range
+        self.count_messages = count_messages
+        self.embedder = embedder
+        self.memories = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.queued = set()
+        # chats that memory has been used for; only these are embedded
+        self.tracked = set()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def memory(self, chat_filename: str) -> ChatMemory:
+        with self.lock:
+            memory = self.memories.get(chat_filename)
+            if memory is None:
+                memory = ChatMemory(chat_filename, self.embedder.name)
+                self.memories[chat_filename] = memory
+            return memory
+
+    def notify(self, chat_filename: str):
+        """Queue a chat for embedding whatever was appended since it was last seen"""
+        with self.lock:
+            if chat_filename not in self.tracked or chat_filename in self.queued:
+                return
+            self.queued.add(chat_filename)
+        self.pending.put(chat_filename)
+
+    def catch_up(self, chat_filename: str):
+        memory = self.memory(chat_filename)
+        total = self.count_messages(chat_filename)
+        done = memory.count()
+        while done < total:
+            entries = self.load_range(
+                chat_filename, done, min(done + embed_batch_size, total)
+            )
+            if not entries:
+                break
+            memory.append(self.embedder([entry_text(entry) for entry in entries]))
+            done += len(entries)
+        memory.update_ivf()
+
+    def _work(self):
+        while True:
+            chat_filename = self.pending.get()
+            with self.lock:
+                self.queued.discard(chat_filename)
+            try:
+                self.catch_up(chat_filename)
+            except Exception as e:
+                print(f"Could not embed messages of {chat_filename}: {e}")
+
+    def recall(
+        self, chat_filename: str, recent: list[dict], before: int, k: int = 5
+    ) -> list[dict]:
+        """
+        Entries from before message index `before` that are most similar to the
+        recent messages. Only what has been embedded so far is searched, so this
+        never waits for a chat to be embedded.
+        """
+        with self.lock:
+            self.tracked.add(chat_filename)
+        self.notify(chat_filename)
+        memory = self.memory(chat_filename)
+        if not recent or not memory.count():
+            return []
+        try:
+            query = self.embedder(
+                ["\n".join(entry_text(entry) for entry in recent)]
+            )[0]
+        except Exception as e:
+            print(f"Could not embed the memory query for {chat_filename}: {e}")
+            return []
+        hits = sorted(memory.search(query, k, before))
+        recalled = []
+        for index, _ in hits:
+            recalled.extend(self.load_range(chat_filename, index, index + 1))
+        return recalled
@@ -0,0 +1,212 @@
+import json
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+default_metrics_port = 9464
+
+seconds_buckets = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+tokens_per_second_buckets = (
+    1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+)
+token_count_buckets = (
+    16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768,
+)
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects, one series per label set"""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, label_name: str = None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_name = label_name
+        self.lock = threading.Lock()
+        # label value -> [bucket counts..., +Inf count], sum
+        self.series = {}
+
+    def observe(self, value: float, label: str = None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label)
+            if series is None:
+                series = self.series[label] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {label: (list(counts), total) for label, (counts, total) in self.series.items()}
+        for label, (counts, total) in sorted(series.items(), key=lambda item: item[0] or ""):
+            prefix = f'{self.label_name}="{_escape(label)}",' if self.label_name else ""
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            braces = f"{{{prefix[:-1]}}}" if prefix else ""
+            lines.append(f"{self.name}_sum{braces} {total}")
+            lines.append(f"{self.name}_count{braces} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+stage_seconds = Histogram(
+    "replai_stage_seconds", "Time spent in each stage of building and sending a reply.",
+    seconds_buckets, "stage",
+)
+time_to_first_token_seconds = Histogram(
+    "replai_time_to_first_token_seconds", "Time from submitting a reply to its first token.",
+    seconds_buckets, "model",
+)
+prompt_tokens = Histogram(
+    "replai_prompt_tokens", "Prompt tokens Ollama evaluated per reply.",
+    token_count_buckets, "model",
+)
+prompt_tokens_per_second = Histogram(
+    "replai_prompt_tokens_per_second", "Ollama prefill throughput per reply.",
+    tokens_per_second_buckets, "model",
+)
+generation_tokens_per_second = Histogram(
+    "replai_generation_tokens_per_second", "Ollama decode throughput per reply.",
+    tokens_per_second_buckets, "model",
+)
+histograms = [
+    stage_seconds,
+    time_to_first_token_seconds,
+    prompt_tokens,
+    prompt_tokens_per_second,
+    generation_tokens_per_second,
+]
+
+# where finished traces are appended as NDJSON; None turns the trace log off
+trace_log_filepath = None
+_trace_log_lock = threading.Lock()
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(stage: str):
+    """Time a stage into stage_seconds and into the trace active in this context, if any"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.spans.append((stage, elapsed))
+
+
+class Trace:
+    """
+    The spans and Ollama counters of one request. Spans started anywhere
+    while the trace is active() are collected; active() is entered around
+    synchronous stretches of work only, so a trace can follow a generator
+    across the threads gradio resumes it on.
+    """
+
+    def __init__(self, kind: str, **attributes):
+        self.kind = kind
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+
+    @contextmanager
+    def active(self):
+        token = _current_trace.set(self)
+        try:
+            yield self
+        finally:
+            _current_trace.reset(token)
+
+    def record_generation(self, model: str, job):
+        """Turn a finished GenerationJob's timings into metrics and trace attributes"""
+        stats = job.stats or {}
+        if job.endpoint is not None:
+            self.attributes["endpoint"] = job.endpoint
+        if job.started_at is not None:
+            queued = job.started_at - job.submitted_at
+            stage_seconds.observe(queued, "queue_wait")
+            self.spans.append(("queue_wait", queued))
+        if job.time_to_first_token is not None:
+            time_to_first_token_seconds.observe(job.time_to_first_token, model)
+            self.attributes["time_to_first_token_s"] = job.time_to_first_token
+
+        for stage, key in (
+            ("ollama_load", "load_duration"),
+            ("ollama_prefill", "prompt_eval_duration"),
+            ("ollama_decode", "eval_duration"),
+        ):
+            if stats.get(key):
+                stage_seconds.observe(stats[key] / 1e9, stage)
+                self.spans.append((stage, stats[key] / 1e9))
+
+        if stats.get("prompt_eval_count"):
+            prompt_tokens.observe(stats["prompt_eval_count"], model)
+            self.attributes["prompt_tokens"] = stats["prompt_eval_count"]
+            if stats.get("prompt_eval_duration"):
+                rate = stats["prompt_eval_count"] / (stats["prompt_eval_duration"] / 1e9)
+                prompt_tokens_per_second.observe(rate, model)
+                self.attributes["prompt_tokens_per_second"] = rate
+        if stats.get("eval_count") and stats.get("eval_duration"):
+            rate = stats["eval_count"] / (stats["eval_duration"] / 1e9)
+            generation_tokens_per_second.observe(rate, model)
+            self.attributes["generation_tokens"] = stats["eval_count"]
+            self.attributes["generation_tokens_per_second"] = rate
+
+    def finish(self):
+        if trace_log_filepath is None:
+            return
+        record = {
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "total_s": time.perf_counter() - self.started,
+            **self.attributes,
+            "spans": [{"stage": stage, "seconds": seconds} for stage, seconds in self.spans],
+        }
+        with _trace_log_lock, open(trace_log_filepath, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def exposition() -> str:
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.exposition())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_metrics_server(port: int = default_metrics_port, host: str = "127.0.0.1"):
+    """Serve /metrics for Prometheus to scrape, from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,318 @@
+import os
+import json
+import tempfile
+import threading
+from array import array
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks outside of POSIX, appends are still serialized within the process
+    fcntl = None
+
+cache_filepath = "cache"
+line_index_filepath = os.path.join(cache_filepath, "line_index")
+
+read_block_size = 64 * 1024
+index_scan_size = 1024 * 1024
+
+# "none" leaves it to the OS, "datasync" forces the data to disk (fdatasync), "fsync" data and metadata
+durability_modes = ("none", "datasync", "fsync")
+default_durability = "datasync"
+
+
+def read_last_lines(path: str, n: int, end: int = None) -> list[bytes]:
+    """Read the last n non-empty lines of a file by seeking backwards from the end"""
+    if n <= 0:
+        return []
+
+    lines = []
+    with open(path, "rb") as f:
+        pos = f.seek(0, os.SEEK_END) if end is None else end
+        buffer = b""
+        while pos > 0 and len(lines) < n:
+            step = min(read_block_size, pos)
+            pos -= step
+            f.seek(pos)
+            parts = (f.read(step) + buffer).split(b"\n")
+            # the first part may be cut off mid-line, keep it for the next block
+            buffer = parts[0]
+            for part in reversed(parts[1:]):
+                if part.strip():
+                    lines.append(part)
+                    if len(lines) == n:
+                        break
+        if len(lines) < n and buffer.strip():
+            lines.append(buffer)
+
+    lines.reverse()
+    return lines
+
+
+def last_line_end(f, size: int) -> int:
+    """Byte offset just past the last newline before size, i.e. the end of the last complete line"""
+    pos = size
+    while pos > 0:
+        step = min(read_block_size, pos)
+        pos -= step
+        f.seek(pos)
+        newline = f.read(step).rfind(b"\n")
+        if newline != -1:
+            return pos + newline + 1
+    return 0
+
+
+# chat path -> lock held while its line index is read, extended and written
+_line_index_locks = {}
+_line_index_locks_lock = threading.Lock()
+
+
+def _line_index_lock(path: str) -> threading.Lock:
+    with _line_index_locks_lock:
+        lock = _line_index_locks.get(path)
+        if lock is None:
+            lock = _line_index_locks[path] = threading.Lock()
+        return lock
+
+
+def _line_index_path(path: str) -> str:
+    return os.path.join(line_index_filepath, os.path.basename(path) + ".idx")
+
+
+def _read_line_index(path: str) -> tuple[int, array]:
+    """Load the sidecar index: the byte size it covers and the offset of every line"""
+    offsets = array("Q")
+    try:
+        with open(_line_index_path(path), "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return 0, offsets
+    header, body = data[:8], data[8:]
+    if len(header) < 8 or len(body) % offsets.itemsize:
+        return 0, offsets
+    offsets.frombytes(body)
+    return array("Q", header)[0], offsets
+
+
+def indexed_size(path: str) -> int:
+    """Byte size of the file the sidecar index covers, without reading the offsets"""
+    try:
+        with open(_line_index_path(path), "rb") as f:
+            header = f.read(8)
+    except FileNotFoundError:
+        return 0
+    return array("Q", header)[0] if len(header) == 8 else 0
+
+
+def _write_line_index(path: str, indexed_size: int, offsets: array):
+    os.makedirs(line_index_filepath, exist_ok=True)
+    # a temporary file of its own, so that another process updating the same index can't mix in
+    fd, tmp_path = tempfile.mkstemp(dir=line_index_filepath, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(array("Q", [indexed_size]).tobytes())
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, _line_index_path(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _index_is_valid(f, size: int, indexed_size: int) -> bool:
+    if indexed_size > size:
+        return False
+    if indexed_size == 0:
+        return True
+    f.seek(indexed_size - 1)
+    return f.read(1) == b"\n"
+
+
+def update_line_index(path: str) -> tuple[array, int]:
+    """
+    Bring the sidecar line-offset index up to date with the file and return
+    (offsets, end), where end is the byte offset the indexed lines stop at.
+    Only bytes appended since the last update are scanned; a truncated or
+    replaced file is re-indexed from scratch. A trailing line without a newline
+    is not indexed yet, as it may still be in the middle of being written.
+    """
+    with _line_index_lock(path):
+        return _update_line_index(path)
+
+
+def _update_line_index(path: str) -> tuple[array, int]:
+    indexed_size, offsets = _read_line_index(path)
+
+    with open(path, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        if not _index_is_valid(f, size, indexed_size):
+            indexed_size, offsets = 0, array("Q")
+        if indexed_size == size:
+            return offsets, indexed_size
+
+        f.seek(indexed_size)
+        pos = indexed_size
+        pending = b""
+        while True:
+            chunk = f.read(index_scan_size)
+            if not chunk:
+                break
+            data = pending + chunk
+            start = 0
+            while True:
+                newline = data.find(b"\n", start)
+                if newline == -1:
+                    break
+                if data[start:newline].strip():
+                    offsets.append(pos + start)
+                start = newline + 1
+            pos += start
+            pending = data[start:]
+
+    if pos != indexed_size:
+        _write_line_index(path, pos, offsets)
+    return offsets, pos
+
+
+def count_lines(path: str) -> int:
+    """Number of non-empty lines in the file, answered from the line index"""
+    offsets, end = update_line_index(path)
+    with open(path, "rb") as f:
+        f.seek(end)
+        has_tail = bool(f.read().strip())
+    return len(offsets) + has_tail
+
+
+def read_line_range(path: str, start: int, stop: int) -> list[bytes]:
+    """Read non-empty lines [start, stop) using the line index, touching only those bytes"""
+    offsets, end = update_line_index(path)
+    start = max(start, 0)
+
+    lines = []
+    with open(path, "rb") as f:
+        if start < len(offsets) and stop > start:
+            f.seek(offsets[start])
+            range_end = offsets[stop] if stop < len(offsets) else end
+            data = f.read(range_end - offsets[start])
+            lines = [line for line in data.split(b"\n") if line.strip()]
+        if stop > len(offsets) and start <= len(offsets):
+            f.seek(end)
+            tail = f.read()
+            if tail.strip():
+                lines.append(tail)
+    return lines
+
+
+# hashes of the unreadable lines already reported, so each is only printed once
+_reported_unreadable = set()
+
+
+def unreadable_entry() -> dict:
+    return {"sender": "", "content": "", "date": "", "time": "", "unreadable": True}
+
+
+def parse_ndjson_lines(lines: list[bytes]) -> list[dict]:
+    """
+    json.loads every line. A line torn by a crash mid-write becomes an
+    unreadable_entry() rather than being skipped, so entries stay aligned with
+    the line index that counts it.
+    """
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            if hash(line) not in _reported_unreadable:
+                _reported_unreadable.add(hash(line))
+                print(f"Unreadable chat line: {line[:80]!r}")
+            entries.append(unreadable_entry())
+    return entries
+
+
+class NdjsonWriter:
+    """
+    Appends to one NDJSON file with group commit: while one thread is writing,
+    lines from other threads pile up and are then written, made durable and
+    released together in a single write. Each batch is written under an
+    exclusive advisory lock, so other processes can't interleave with it, and
+    a torn last line left behind by a crash is terminated before appending.
+    """
+
+    def __init__(self, path: str, durability: str = default_durability):
+        if durability not in durability_modes:
+            raise ValueError(f"durability must be one of {durability_modes}")
+        self.path = path
+        self.durability = durability
+        self.condition = threading.Condition()
+        self.pending = []
+        self.batch = 0
+        self.committed = 0
+        self.committing = False
+        # batch -> [error, appends in the batch that haven't raised it yet]
+        self.errors = {}
+
+    def _write(self, lines: list[bytes]):
+        with open(self.path, "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                size = f.seek(0, os.SEEK_END)
+                if size:
+                    f.seek(size - 1)
+                    if f.read(1) != b"\n":
+                        lines.insert(0, b"\n")
+                f.write(b"".join(lines))
+                f.flush()
+                if self.durability == "datasync":
+                    getattr(os, "fdatasync", os.fsync)(f.fileno())
+                elif self.durability == "fsync":
+                    os.fsync(f.fileno())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def append(self, entry: dict):
+        """Append one entry, returning once the batch holding it has been committed"""
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.condition:
+            self.pending.append(line)
+            batch = self.batch
+            while self.committed <= batch:
+                if self.committing:
+                    self.condition.wait()
+                    continue
+                # nobody is writing, so this thread commits everything pending
+                self.committing = True
+                lines, self.pending = self.pending, []
+                appends = len(lines)
+                writing = self.batch
+                self.batch += 1
+                self.condition.release()
+                try:
+                    self._write(lines)
+                except Exception as e:
+                    self.errors[writing] = [e, appends]
+                finally:
+                    self.condition.acquire()
+                    self.committing = False
+                    self.committed = writing + 1
+                    self.condition.notify_all()
+            error = self.errors.get(batch)
+            if error is not None:
+                error[1] -= 1
+                if not error[1]:
+                    del self.errors[batch]
+        if error is not None:
+            raise error[0]
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path: str, durability: str = default_durability) -> NdjsonWriter:
+    """Shared writer per chat file, so group commit sees every append in the process"""
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None or writer.durability != durability:
+            writer = _writers[path] = NdjsonWriter(path, durability)
+        return writer
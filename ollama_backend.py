@@ -0,0 +1,492 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+from backends import (
+    EndpointRouter,
+    make_endpoint,
+    default_routing,
+    health_interval,
+    is_connection_error,
+    is_missing_model_error,
+)
+
+# how many generations may run at once on one model, unless set in max_concurrent_per_model
+default_max_concurrent = 1
+# waiting requests per model before new ones are turned away
+default_max_queued = 32
+# tokens a background generation such as a summary may produce
+background_num_predict = 256
+
+
+class BackendBusy(Exception):
+    pass
+
+
+class Preempted(BackendBusy):
+    """A background job was stopped to make room for one somebody is waiting for"""
+
+
+def parse_keep_alive(keep_alive):
+    """
+    Ollama takes a duration with a unit ("30m") or a number of seconds, so a
+    bare number typed as text ("-1", "0", "300") is sent as a number
+    """
+    if isinstance(keep_alive, str):
+        keep_alive = keep_alive.strip()
+        try:
+            return int(keep_alive)
+        except ValueError:
+            pass
+        try:
+            return float(keep_alive)
+        except ValueError:
+            pass
+    return keep_alive or None
+
+
+class GenerationJob:
+    """One chat request waiting for, or holding, a slot on its model"""
+
+    def __init__(self, pool, chat_key: str, request: dict, background: bool = False):
+        self.pool = pool
+        self.chat_key = chat_key
+        self.request = request
+        # background jobs queue behind interactive ones and give way to them
+        self.background = background
+        self.preempted = False
+        self.events = queue.Queue()
+        self.position = None
+        self.started = None
+        self.task = None
+        # timing counters from Ollama's final chunk, once the reply is done
+        self.stats = {}
+        # text received so far, for consumers that poll instead of streaming
+        self.text = ""
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.first_token_at = None
+        # name of the server that generated the reply
+        self.endpoint = None
+
+    @property
+    def time_to_first_token(self) -> float:
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.submitted_at
+
+    def stream(self):
+        """
+        Yield ("queued", position), ("token", text so far) and finally
+        ("done", full text) events from the calling thread. Closing the
+        generator early cancels the request; if it is cancelled some other
+        way the stream just ends.
+        """
+        finished = False
+        try:
+            while True:
+                kind, value = self.events.get()
+                if kind == "cancelled":
+                    finished = True
+                    return
+                if kind == "error":
+                    finished = True
+                    raise value
+                if kind == "done":
+                    finished = True
+                yield kind, value
+                if finished:
+                    return
+        finally:
+            if not finished:
+                self.cancel()
+
+    def result(self) -> str:
+        """The full reply, or None if the job was cancelled"""
+        for kind, value in self.stream():
+            if kind == "done":
+                return value
+
+    def cancel(self):
+        self.pool.loop.call_soon_threadsafe(self.pool._cancel, self)
+
+    def preempt(self):
+        """Called on the pool's loop: stop a running background job, its consumer gets Preempted"""
+        self.preempted = True
+        if self.task is not None:
+            self.task.cancel()
+
+
+class ModelScheduler:
+    """
+    FIFO queue for one model. At most max_concurrent jobs run at once and a
+    chat never has more than one job running, so replies within a chat keep
+    their order while other chats can overtake a chat that is still busy.
+    Background jobs wait behind every interactive one, and a running
+    background job is preempted when an interactive job can't start
+    because of it.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.waiting = deque()
+        self.running = set()
+        self.busy_chats = set()
+
+    def add(self, job: GenerationJob):
+        if len(self.waiting) >= self.max_queued:
+            raise BackendBusy("Too many messages are waiting for this model.")
+        if job.background:
+            self.waiting.append(job)
+        else:
+            position = next(
+                (i for i, waiting in enumerate(self.waiting) if waiting.background),
+                len(self.waiting),
+            )
+            self.waiting.insert(position, job)
+        self.dispatch()
+
+    def remove(self, job: GenerationJob):
+        if job in self.waiting:
+            self.waiting.remove(job)
+        elif job in self.running:
+            self.running.discard(job)
+            self.busy_chats.discard(job.chat_key)
+        self.dispatch()
+
+    def dispatch(self):
+        for job in list(self.waiting):
+            if len(self.running) >= self.max_concurrent:
+                break
+            if job.chat_key in self.busy_chats:
+                continue
+            self.waiting.remove(job)
+            self.running.add(job)
+            self.busy_chats.add(job.chat_key)
+            job.started.set()
+        self._preempt_background()
+        for position, job in enumerate(self.waiting, start=1):
+            if job.position != position:
+                job.position = position
+                job.events.put(("queued", position))
+
+    def _preempt_background(self):
+        # slots that running background jobs have been asked to give back
+        free = sum(job.preempted for job in self.running)
+        for job in self.waiting:
+            if job.background:
+                break
+            holder = next((r for r in self.running if r.chat_key == job.chat_key), None)
+            if holder is not None:
+                if holder.background and not holder.preempted:
+                    holder.preempt()
+                continue
+            if free > 0:
+                free -= 1
+                continue
+            victim = next(
+                (r for r in self.running if r.background and not r.preempted), None
+            )
+            if victim is None:
+                break
+            victim.preempt()
+
+
+class BackendPool:
+    """
+    Runs every generation request on one asyncio loop in a background thread,
+    sharing each server's client and its pooled HTTP connections. Gradio
+    handlers stay synchronous and consume results through GenerationJob.stream.
+
+    endpoints are dicts for backends.make_endpoint, by default the local
+    Ollama at host. A model's queue lets as many requests run at once as the
+    healthy servers that have it have slots, unless max_concurrent_per_model
+    says otherwise, and the router picks the server for each of them.
+    """
+
+    def __init__(
+        self,
+        host: str = None,
+        max_concurrent_per_model: dict = None,
+        max_queued: int = default_max_queued,
+        endpoints: list[dict] = None,
+        routing: str = default_routing,
+    ):
+        self.endpoint_specs = endpoints or [
+            {"kind": "ollama", "url": host, "max_concurrent": default_max_concurrent}
+        ]
+        self.routing = routing
+        self.max_concurrent_per_model = max_concurrent_per_model or {}
+        self.max_queued = max_queued
+        self.schedulers = {}
+        # built here rather than on the loop, so callers can use it as soon as the pool exists
+        self.router = EndpointRouter(
+            [make_endpoint(spec) for spec in self.endpoint_specs], self.routing
+        )
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._check_health())
+        self.loop.run_forever()
+
+    async def _check_health(self):
+        while True:
+            await self.router.check_health()
+            self._update_capacity()
+            await asyncio.sleep(health_interval)
+
+    def _update_capacity(self):
+        for model, scheduler in self.schedulers.items():
+            if model not in self.max_concurrent_per_model:
+                scheduler.max_concurrent = self.router.capacity(model)
+                scheduler.dispatch()
+
+    def _scheduler(self, model: str) -> ModelScheduler:
+        scheduler = self.schedulers.get(model)
+        if scheduler is None:
+            max_concurrent = self.max_concurrent_per_model.get(model)
+            scheduler = ModelScheduler(
+                max_concurrent or self.router.capacity(model),
+                self.max_queued,
+            )
+            self.schedulers[model] = scheduler
+        return scheduler
+
+    def submit(
+        self,
+        model: str,
+        chat_key: str,
+        messages: list[dict],
+        options: dict = None,
+        keep_alive: str = None,
+        background: bool = False,
+    ) -> GenerationJob:
+        """
+        Queue a chat request; raises BackendBusy if the model's queue is full.
+        A background job's result() raises Preempted if it had to give way.
+        """
+        job = GenerationJob(
+            self,
+            chat_key,
+            {
+                "model": model,
+                "messages": messages,
+                "options": options or None,
+                "keep_alive": parse_keep_alive(keep_alive),
+            },
+            background,
+        )
+        accepted = asyncio.run_coroutine_threadsafe(self._enqueue(job), self.loop)
+        accepted.result()
+        return job
+
+    async def _enqueue(self, job: GenerationJob):
+        job.started = asyncio.Event()
+        self._scheduler(job.request["model"]).add(job)
+        job.task = asyncio.ensure_future(self._run(job))
+
+    async def _run(self, job: GenerationJob):
+        scheduler = self._scheduler(job.request["model"])
+        try:
+            await job.started.wait()
+            if job.preempted:
+                raise Preempted("Gave way to a reply somebody is waiting for.")
+            job.started_at = time.monotonic()
+            outcome = ("done", await self._generate(job))
+        except asyncio.CancelledError:
+            if job.preempted:
+                outcome = ("error", Preempted("Gave way to a reply somebody is waiting for."))
+            else:
+                outcome = ("cancelled", None)
+        except Exception as e:
+            outcome = ("error", e)
+        finally:
+            scheduler.remove(job)
+        # only reported once the slot is free, so is_idle() is accurate by then
+        job.events.put(outcome)
+
+    async def _generate(self, job: GenerationJob) -> str:
+        """
+        Stream the reply from the server the router picks. A server that can't
+        be reached, or doesn't have the model, is skipped for the next one as
+        long as no token has arrived yet; one that can't be reached is also
+        marked unhealthy until its next successful health check.
+        """
+        model = job.request["model"]
+        tried = set()
+        last_error = None
+        while True:
+            endpoint = self.router.pick(model, job.chat_key, exclude=tried)
+            if endpoint is None:
+                raise last_error or BackendBusy(f"No server has {model}.")
+            tried.add(endpoint)
+            job.endpoint = endpoint.name
+            endpoint.in_flight += 1
+            text = ""
+            try:
+                async for chunk in endpoint.chat(
+                    model,
+                    job.request["messages"],
+                    job.request["options"],
+                    job.request["keep_alive"],
+                ):
+                    if job.first_token_at is None:
+                        job.first_token_at = time.monotonic()
+                    text += chunk["content"]
+                    job.text = text
+                    if chunk.get("done"):
+                        job.stats = {
+                            key: value
+                            for key, value in chunk.items()
+                            if key not in ("content", "done")
+                        }
+                    job.events.put(("token", text))
+                return text
+            except Exception as e:
+                if text or not (is_connection_error(e) or is_missing_model_error(e)):
+                    raise
+                last_error = e
+                if is_connection_error(e):
+                    print(f"{endpoint.name} failed, trying another server: {e}")
+                    endpoint.healthy = False
+                    self._update_capacity()
+            finally:
+                endpoint.in_flight -= 1
+
+    def list_models(self, timeout: float = None) -> list[str]:
+        """Blocking: every model some healthy server has"""
+        future = asyncio.run_coroutine_threadsafe(self.router.list_models(), self.loop)
+        return future.result(timeout)
+
+    def embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        """
+        Blocking: one embedding per text, from a server the router picks.
+        Skips to the next server like _generate when one can't be reached or
+        doesn't have the model. Embeddings are short, so they don't queue
+        behind generations.
+        """
+        return asyncio.run_coroutine_threadsafe(self._embed(model, texts), self.loop).result()
+
+    async def _embed(self, model: str, texts: list[str]) -> list[list[float]]:
+        tried = set()
+        last_error = None
+        while True:
+            endpoint = self.router.pick(model, None, exclude=tried)
+            if endpoint is None:
+                raise last_error or BackendBusy(f"No server has {model}.")
+            tried.add(endpoint)
+            endpoint.in_flight += 1
+            try:
+                return await endpoint.embed(model, texts)
+            except Exception as e:
+                if not (is_connection_error(e) or is_missing_model_error(e)):
+                    raise
+                last_error = e
+                if is_connection_error(e):
+                    print(f"{endpoint.name} failed, trying another server: {e}")
+                    endpoint.healthy = False
+                    self._update_capacity()
+            finally:
+                endpoint.in_flight -= 1
+
+    def warm_up(self, model: str, keep_alive: str = None):
+        """Ask every server that has the model to load it, without waiting"""
+
+        async def warm_up_all():
+            for endpoint in self.router.candidates(model):
+                try:
+                    await endpoint.warm_up(model, parse_keep_alive(keep_alive))
+                except Exception as e:
+                    print(f"Failed to warm up {model} on {endpoint.name}: {e}")
+
+        asyncio.run_coroutine_threadsafe(warm_up_all(), self.loop)
+
+    def is_idle(self) -> bool:
+        """True when no request is running or waiting on any model"""
+        return not any(
+            scheduler.running or scheduler.waiting
+            for scheduler in list(self.schedulers.values())
+        )
+
+    def generate_text(
+        self,
+        model: str,
+        prompt: str,
+        chat_key: str = "background",
+        num_predict: int = background_num_predict,
+    ) -> str:
+        """
+        Blocking single-prompt helper for background work such as summaries.
+        Runs as a background job, so it raises Preempted if a reply needs the slot.
+        """
+        job = self.submit(
+            model,
+            chat_key,
+            [{"role": "user", "content": prompt}],
+            {"num_predict": num_predict},
+            background=True,
+        )
+        return job.result()
+
+    def _cancel(self, job: GenerationJob):
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            self._scheduler(job.request["model"]).remove(job)
+
+
+class ModelList:
+    """
+    Names of the models the backend has, fetched in a background thread and
+    cached for ttl seconds. Lookups never block on a slow or offline backend
+    for longer than they ask to; they get the last known list instead.
+    fetch() returns the names, e.g. BackendPool.list_models.
+    """
+
+    def __init__(self, fetch, ttl: float = 60.0):
+        self.ttl = ttl
+        self.fetch = fetch
+        self.models = []
+        self.fetched_at = None
+        self.fetching = None
+        self.lock = threading.Lock()
+
+    def _fetch(self, done: threading.Event):
+        try:
+            models = self.fetch()
+            with self.lock:
+                self.models = models
+                self.fetched_at = time.monotonic()
+        except Exception as e:
+            print(f"Could not list models: {e}")
+        finally:
+            with self.lock:
+                self.fetching = None
+            done.set()
+
+    def refresh(self, wait: float = 0) -> list[str]:
+        """Start a fetch unless one is running, then wait up to wait seconds for it"""
+        with self.lock:
+            done = self.fetching
+            if done is None:
+                done = self.fetching = threading.Event()
+                threading.Thread(target=self._fetch, args=(done,), daemon=True).start()
+        done.wait(wait)
+        with self.lock:
+            return list(self.models)
+
+    def get(self, wait: float = 0) -> list[str]:
+        with self.lock:
+            fresh = (
+                self.fetched_at is not None
+                and time.monotonic() - self.fetched_at < self.ttl
+            )
+            if fresh:
+                return list(self.models)
+        return self.refresh(wait)
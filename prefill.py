@@ -0,0 +1,152 @@
+import time
+import hashlib
+import threading
+
+from ollama_backend import BackendBusy, Preempted
+
+# at most one speculative prefill per chat in this many seconds
+prefill_min_interval = 5.0
+# a reply counts as warm if its chat was prefilled this recently
+prefill_max_age = 300.0
+
+
+def _prefix_hash(messages: list[dict]) -> str:
+    digest = hashlib.sha256()
+    for message in messages:
+        digest.update(message["role"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(message["content"].encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class Prefiller:
+    """
+    Warms Ollama's KV cache with a chat's prompt before the user sends their
+    message, by asking for a single token over the exact messages the next
+    reply will start with. The reply then only has to prefill the new tail.
+    Prefills run as background jobs, so a real reply preempts them.
+    Also keeps time-to-first-token stats for warm and cold replies.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        # chat -> (time of the last prefill, number of messages, hash of those messages)
+        self.prefilled = {}
+        # chat -> hash of the messages of a prefill still in flight
+        self.pending = {}
+        # chat -> time the prompt was last built for a prefill, for the rate limit
+        self.attempted = {}
+        self.totals = {
+            "warm": [0, 0.0],
+            "cold": [0, 0.0],
+        }
+        self.prefill_count = 0
+        self.prefill_seconds = 0.0
+
+    def prefill(
+        self,
+        model: str,
+        chat_key: str,
+        build_messages,
+        options: dict = None,
+        keep_alive: str = None,
+    ) -> bool:
+        """
+        Start a prefill in the background, unless rate limited, the backend is
+        busy or the prompt is already warm. build_messages() returns the
+        prompt; it is only called once the rate limit and idleness checks
+        pass, as this runs on every keystroke.
+        """
+        now = time.monotonic()
+        with self.lock:
+            last_attempt = self.attempted.get(chat_key)
+            if last_attempt is not None and now - last_attempt < prefill_min_interval:
+                return False
+            if not self.pool.is_idle():
+                return False
+            self.attempted[chat_key] = now
+
+        messages = build_messages()
+        prefix_hash = _prefix_hash(messages)
+        with self.lock:
+            last = self.prefilled.get(chat_key)
+            if last is not None and last[2] == prefix_hash:
+                return False
+            if self.pending.get(chat_key) == prefix_hash:
+                return False
+            self.pending[chat_key] = prefix_hash
+
+        try:
+            job = self.pool.submit(
+                model,
+                chat_key,
+                messages,
+                {**(options or {}), "num_predict": 1},
+                keep_alive,
+                background=True,
+            )
+        except BackendBusy:
+            self._settle(chat_key, prefix_hash)
+            return False
+
+        def wait():
+            # only a prefill that ran to the end has warmed the cache
+            try:
+                warmed = job.result() is not None
+            except Preempted:
+                warmed = False
+            except Exception as e:
+                print(f"Prefill of {chat_key} failed: {e}")
+                warmed = False
+            self._settle(chat_key, prefix_hash)
+            if not warmed:
+                return
+            with self.lock:
+                self.prefilled[chat_key] = (time.monotonic(), len(messages), prefix_hash)
+                self.prefill_count += 1
+                self.prefill_seconds += (job.stats.get("prompt_eval_duration") or 0) / 1e9
+
+        threading.Thread(target=wait, daemon=True).start()
+        return True
+
+    def _settle(self, chat_key: str, prefix_hash: str):
+        with self.lock:
+            if self.pending.get(chat_key) == prefix_hash:
+                del self.pending[chat_key]
+
+    def is_warm(self, chat_key: str, messages: list[dict]) -> bool:
+        """Whether a recent prefill covered the start of these messages"""
+        with self.lock:
+            last = self.prefilled.get(chat_key)
+        if last is None or time.monotonic() - last[0] > prefill_max_age:
+            return False
+        _, count, prefix_hash = last
+        return len(messages) >= count and _prefix_hash(messages[:count]) == prefix_hash
+
+    def record_reply(self, warm: bool, time_to_first_token: float):
+        if time_to_first_token is None:
+            return
+        with self.lock:
+            totals = self.totals["warm" if warm else "cold"]
+            totals[0] += 1
+            totals[1] += time_to_first_token
+
+    def report(self) -> str:
+        with self.lock:
+            lines = [
+                f"speculative prefills: {self.prefill_count}, "
+                f"{self.prefill_seconds:.1f}s of prefill done ahead of time"
+            ]
+            averages = {}
+            for kind, (count, seconds) in self.totals.items():
+                if count:
+                    averages[kind] = seconds / count
+                    lines.append(
+                        f"{kind} replies: {count}, {averages[kind] * 1000:.0f} ms to first token on average"
+                    )
+            if len(averages) == 2:
+                saved = averages["cold"] - averages["warm"]
+                lines.append(f"prefill saved {saved * 1000:.0f} ms of time to first token per reply")
+            return "\n".join(lines)
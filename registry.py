@@ -0,0 +1,131 @@
+import os
+import threading
+
+import yaml
+from jinja2 import Template
+
+from metrics import span
+
+
+class FileRegistry:
+    """
+    Keeps the parsed form of every file in a directory that has been asked for.
+    An entry is reloaded when the file's mtime or size changes, so edits made
+    outside of the webui are picked up on the next lookup.
+    """
+
+    def __init__(self, filepath: str, loader, stage: str = "load_file"):
+        self.filepath = filepath
+        self.loader = loader
+        self.stage = stage
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_with_version(self, filename: str):
+        path = os.path.join(self.filepath, filename)
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and entry[0] == version:
+                return entry[1], version
+        with span(self.stage), open(path, encoding="utf-8") as f:
+            value = self.loader(f.read())
+        with self.lock:
+            self.entries[filename] = (version, value)
+        return value, version
+
+    def get(self, filename: str):
+        return self.get_with_version(filename)[0]
+
+    def invalidate(self, filename: str = None):
+        with self.lock:
+            if filename is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(filename, None)
+
+
+class PromptRegistry:
+    """Parsed character cards, compiled system prompt templates and their renders"""
+
+    def __init__(self, character_cards_filepath: str, sys_prompts_filepath: str):
+        self.cards = FileRegistry(character_cards_filepath, yaml.safe_load, "parse_card")
+        self.templates = FileRegistry(sys_prompts_filepath, Template, "compile_template")
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    def card(self, filename: str) -> dict:
+        return self.cards.get(filename)
+
+    def card_name(self, filename: str) -> str:
+        return self.card(filename).get("name")
+
+    def template(self, filename: str) -> Template:
+        return self.templates.get(filename)
+
+    def system_message(
+        self,
+        sys_prompt_filename: str,
+        ai_chara_card_filename: str,
+        user_chara_card_filename: str,
+    ) -> str:
+        """Render a system prompt for a pair of cards, memoized until any of the three files changes"""
+        template, template_version = self.templates.get_with_version(
+            sys_prompt_filename
+        )
+        ai_card, ai_version = self.cards.get_with_version(ai_chara_card_filename)
+        user_card, user_version = self.cards.get_with_version(
+            user_chara_card_filename
+        )
+
+        key = (sys_prompt_filename, ai_chara_card_filename, user_chara_card_filename)
+        version = (template_version, ai_version, user_version)
+        with self.lock:
+            cached = self.rendered.get(key)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        with span("render_system_prompt"):
+            message = template.render(
+                ai={"name": ai_card["name"], "description": ai_card["description"]},
+                user={"name": user_card["name"], "description": user_card["description"]},
+            )
+        with self.lock:
+            self.rendered[key] = (version, message)
+        return message
+
+    def group_system_message(
+        self,
+        sys_prompt_filename: str,
+        speaker_chara_card_filename: str,
+        user_chara_card_filename: str,
+        member_chara_card_filenames: list[str],
+    ) -> str:
+        """
+        Render a system prompt for one AI in a group chat. Besides ai and user,
+        the template gets others: every other member of the chat, user included.
+        """
+        template = self.template(sys_prompt_filename)
+        speaker = self.card(speaker_chara_card_filename)
+        user_card = self.card(user_chara_card_filename)
+        others = [
+            {"name": card["name"], "description": card["description"]}
+            for card in (
+                self.card(filename)
+                for filename in [user_chara_card_filename, *member_chara_card_filenames]
+            )
+            if card["name"] != speaker["name"]
+        ]
+        return template.render(
+            ai={"name": speaker["name"], "description": speaker["description"]},
+            user={"name": user_card["name"], "description": user_card["description"]},
+            others=others,
+        )
+
+    def refresh(self):
+        """Drop everything, e.g. after a card or prompt was saved or deleted from the webui"""
+        self.cards.invalidate()
+        self.templates.invalidate()
+        with self.lock:
+            self.rendered.clear()
@@ -0,0 +1,324 @@
+import os
+import re
+import copy
+import time
+import queue
+import pickle
+import threading
+from array import array
+
+import numpy as np
+
+from sqlite_store import to_timestamp
+
+search_filepath = os.path.join("cache", "search")
+index_path = os.path.join(search_filepath, "index.pickle")
+index_version = 1
+
+# seconds between saves of the index, if anything changed
+save_interval = 30.0
+# messages read per batch while indexing a chat
+index_batch_size = 4096
+default_max_results = 50
+
+# a message id is the chat's id in the upper bits and the message index in the lower
+index_bits = 40
+index_mask = (1 << index_bits) - 1
+
+token_pattern = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> set[str]:
+    return set(token_pattern.findall(text.lower()))
+
+
+class ChatIndexState:
+    """How far one chat has been indexed, and its message timestamps"""
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.count = 0
+        # file size when last indexed; a smaller file means it was rewritten
+        self.size = 0
+        # seconds (see sqlite_store.to_timestamp) of every indexed message
+        self.timestamps = array("q")
+        self.ordered = True
+
+
+class SearchIndex:
+    """
+    Inverted index (token -> message ids) plus per-chat timestamp arrays over
+    every chat. Messages are indexed in a background thread as they are
+    appended, parsed once; the index is pickled to disk now and then and on
+    start only the messages added since are read. A chat that shrank is
+    indexed again under a new id, and the old id's postings are dropped on
+    the next save.
+
+    load_range(chat_filename, start, stop), count_messages(chat_filename),
+    chat_size(chat_filename) and list_chats() read the chats, so any storage
+    backend can be used.
+    """
+
+    def __init__(self, load_range, count_messages, chat_size, list_chats):
+        self.load_range = load_range
+        self.count_messages = count_messages
+        self.chat_size = chat_size
+        self.list_chats = list_chats
+        self.lock = threading.Lock()
+        # chat filename -> ChatIndexState
+        self.chats = {}
+        # chat id -> chat filename, None once the chat was re-indexed under a new id
+        self.chat_names = []
+        self.postings = {}
+        self.dirty = False
+        self.pending = queue.Queue()
+        self.queued = set()
+        self.ready = threading.Event()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def _load(self):
+        try:
+            with open(index_path, "rb") as f:
+                saved = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return
+        if saved.get("version") != index_version:
+            return
+        with self.lock:
+            self.chats = saved["chats"]
+            self.chat_names = saved["chat_names"]
+            self.postings = saved["postings"]
+
+    def _save(self):
+        # arrays are only ever appended to, so noting their lengths under the lock
+        # is enough to pickle them as they are now while indexing goes on
+        with self.lock:
+            if not self.dirty:
+                return
+            if None in self.chat_names:
+                self._drop_dead_postings()
+            chats = {
+                name: (copy.copy(state), len(state.timestamps))
+                for name, state in self.chats.items()
+            }
+            postings = [(token, ids, len(ids)) for token, ids in self.postings.items()]
+            chat_names = list(self.chat_names)
+            self.dirty = False
+        for state, length in chats.values():
+            state.timestamps = state.timestamps[:length]
+        data = pickle.dumps(
+            {
+                "version": index_version,
+                "chats": {name: state for name, (state, _) in chats.items()},
+                "chat_names": chat_names,
+                "postings": {token: ids[:length] for token, ids, length in postings},
+            },
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        os.makedirs(search_filepath, exist_ok=True)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, index_path)
+
+    def _drop_dead_postings(self):
+        dead = np.array(
+            [chat_id for chat_id, name in enumerate(self.chat_names) if name is None],
+            dtype=np.uint64,
+        )
+        for token, ids in list(self.postings.items()):
+            ids = np.frombuffer(ids, dtype=np.uint64)
+            alive = ids[~np.isin(ids >> np.uint64(index_bits), dead)]
+            if len(alive):
+                self.postings[token] = array("Q", alive.tobytes())
+            else:
+                del self.postings[token]
+        # keep the ids, so that live chats keep theirs, but forget the dead names
+        self.chat_names = [name if name is not None else "" for name in self.chat_names]
+
+    def notify(self, chat_filename: str):
+        """Queue a chat for indexing whatever was appended since it was last seen"""
+        with self.lock:
+            if chat_filename in self.queued:
+                return
+            self.queued.add(chat_filename)
+        self.pending.put(chat_filename)
+
+    def catch_up(self, chat_filename: str):
+        total = self.count_messages(chat_filename)
+        size = self.chat_size(chat_filename)
+        with self.lock:
+            state = self.chats.get(chat_filename)
+            if state is None or total < state.count or size < state.size:
+                if state is not None:
+                    self.chat_names[state.chat_id] = None
+                state = ChatIndexState(len(self.chat_names))
+                self.chat_names.append(chat_filename)
+                self.chats[chat_filename] = state
+                self.dirty = True
+            done = state.count
+
+        while done < total:
+            entries = self.load_range(
+                chat_filename, done, min(done + index_batch_size, total)
+            )
+            if not entries:
+                break
+            self._add(state, done, entries)
+            done += len(entries)
+        with self.lock:
+            state.size = size
+
+    def _add(self, state: ChatIndexState, start: int, entries: list[dict]):
+        batch = {}
+        timestamps = []
+        # most messages share their date with a neighbour, so each date is parsed once
+        days = {}
+        for offset, entry in enumerate(entries):
+            message_id = (state.chat_id << index_bits) | (start + offset)
+            for token in tokenize(entry["content"] + " " + entry["sender"]):
+                ids = batch.get(token)
+                if ids is None:
+                    batch[token] = [message_id]
+                else:
+                    ids.append(message_id)
+            try:
+                day = days.get(entry["date"])
+                if day is None:
+                    day = days[entry["date"]] = to_timestamp(entry["date"], "00:00")
+                hours, minutes = entry["time"].split(":")
+                timestamp = day + int(hours) * 3600 + int(minutes) * 60
+            except (KeyError, ValueError):
+                timestamp = timestamps[-1] if timestamps else 0
+            timestamps.append(timestamp)
+        ordered = not any(a > b for a, b in zip(timestamps, timestamps[1:]))
+        with self.lock:
+            # the count goes first, so a batch that fails halfway is never indexed twice
+            if state.timestamps and timestamps and timestamps[0] < state.timestamps[-1]:
+                ordered = False
+            state.timestamps.extend(timestamps)
+            state.count = start + len(entries)
+            state.ordered = state.ordered and ordered
+            for token, message_ids in batch.items():
+                ids = self.postings.get(token)
+                if ids is None:
+                    self.postings[token] = array("Q", message_ids)
+                else:
+                    ids.extend(message_ids)
+            self.dirty = True
+
+    def _work(self):
+        self._load()
+        for chat_filename in self.list_chats():
+            self.notify(chat_filename)
+        last_save = time.monotonic()
+        while True:
+            try:
+                chat_filename = self.pending.get(timeout=save_interval)
+            except queue.Empty:
+                chat_filename = None
+            if chat_filename is not None:
+                with self.lock:
+                    self.queued.discard(chat_filename)
+                try:
+                    self.catch_up(chat_filename)
+                except Exception as e:
+                    print(f"Could not index {chat_filename}: {e}")
+            if self.pending.empty():
+                self.ready.set()
+            if time.monotonic() - last_save >= save_interval or (
+                chat_filename is None and self.dirty
+            ):
+                try:
+                    self._save()
+                except OSError as e:
+                    print(f"Could not save the search index: {e}")
+                last_save = time.monotonic()
+
+    def _candidate_ids(self, tokens: set[str]) -> np.ndarray:
+        postings = []
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                return np.empty(0, dtype=np.uint64)
+            postings.append(np.frombuffer(ids, dtype=np.uint64))
+        postings.sort(key=len)
+        found = postings[0]
+        for ids in postings[1:]:
+            found = np.intersect1d(found, ids, assume_unique=True)
+            if not len(found):
+                break
+        return found
+
+    def _range_ids(self, state: ChatIndexState, ts_from: int, ts_to: int) -> np.ndarray:
+        timestamps = np.frombuffer(state.timestamps, dtype=np.int64)[: state.count]
+        if state.ordered:
+            start = np.searchsorted(timestamps, ts_from, side="left") if ts_from is not None else 0
+            stop = np.searchsorted(timestamps, ts_to, side="left") if ts_to is not None else len(timestamps)
+            indices = np.arange(start, stop, dtype=np.uint64)
+        else:
+            mask = np.ones(len(timestamps), dtype=bool)
+            if ts_from is not None:
+                mask &= timestamps >= ts_from
+            if ts_to is not None:
+                mask &= timestamps < ts_to
+            indices = np.nonzero(mask)[0].astype(np.uint64)
+        return (np.uint64(state.chat_id) << np.uint64(index_bits)) | indices
+
+    def search(
+        self,
+        query: str = "",
+        ts_from: int = None,
+        ts_to: int = None,
+        chat_filenames: list[str] = None,
+        max_results: int = default_max_results,
+    ) -> tuple[list[tuple[str, int, int]], int]:
+        """
+        Messages containing every word of the query, with ts_from <= timestamp
+        < ts_to, newest first. Returns up to max_results (chat filename,
+        message index, timestamp) and the total number of matches.
+        """
+        tokens = tokenize(query)
+        with self.lock:
+            states = [
+                state
+                for name, state in self.chats.items()
+                if not chat_filenames or name in chat_filenames
+            ]
+            if tokens:
+                ids = self._candidate_ids(tokens)
+            elif ts_from is not None or ts_to is not None:
+                ranges = [self._range_ids(state, ts_from, ts_to) for state in states]
+                ids = np.concatenate(ranges) if ranges else np.empty(0, dtype=np.uint64)
+            else:
+                return [], 0
+
+            # sorted ids are grouped by chat, so each chat's timestamps are looked up in one go
+            ids = np.sort(ids)
+            chat_ids = (ids >> np.uint64(index_bits)).astype(np.int64)
+            indices = (ids & np.uint64(index_mask)).astype(np.int64)
+            timestamps = np.zeros(len(ids), dtype=np.int64)
+            keep = np.zeros(len(ids), dtype=bool)
+            chat_timestamps = None
+            for state in states:
+                start, stop = np.searchsorted(chat_ids, [state.chat_id, state.chat_id + 1])
+                if start == stop:
+                    continue
+                chat_timestamps = np.frombuffer(state.timestamps, dtype=np.int64)
+                stop = start + np.searchsorted(indices[start:stop], len(chat_timestamps))
+                timestamps[start:stop] = chat_timestamps[indices[start:stop]]
+                keep[start:stop] = True
+            # a view left alive would stop _add from growing the array after the lock is released
+            del chat_timestamps
+            names = list(self.chat_names)
+
+        if tokens:
+            if ts_from is not None:
+                keep &= timestamps >= ts_from
+            if ts_to is not None:
+                keep &= timestamps < ts_to
+        chat_ids, indices, timestamps = chat_ids[keep], indices[keep], timestamps[keep]
+        order = np.lexsort((indices, timestamps))[::-1][:max_results]
+        return [
+            (names[chat_ids[i]], int(indices[i]), int(timestamps[i])) for i in order
+        ], int(keep.sum())
@@ -0,0 +1,257 @@
+import os
+import json
+import sqlite3
+import argparse
+import calendar
+import threading
+from datetime import datetime, timezone
+
+sqlite_chat_extension = ".sqlite"
+
+date_format = "%d/%m/%Y"
+time_format = "%H:%M"
+
+schema = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sender TEXT NOT NULL,
+    content TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    extra TEXT,
+    pos INTEGER
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+"""
+# position of every message within the chat, so lookups by position and the
+# count are index lookups rather than scans; added to chats created without it
+position_schema = """
+CREATE INDEX IF NOT EXISTS messages_pos ON messages (pos);
+"""
+
+
+def is_sqlite_chat(filename: str) -> bool:
+    return filename.endswith(sqlite_chat_extension)
+
+
+def to_timestamp(date_str: str, time_str: str) -> int:
+    """
+    The NDJSON date and time carry no timezone, so they are stored as wall-clock
+    seconds (as if they were UTC). That keeps them orderable and range-queryable
+    while converting back to exactly the same strings.
+    """
+    parsed = datetime.strptime(f"{date_str} {time_str}", f"{date_format} {time_format}")
+    return calendar.timegm(parsed.timetuple())
+
+
+def from_timestamp(ts: int) -> tuple[str, str]:
+    moment = datetime.fromtimestamp(ts, timezone.utc)
+    return moment.strftime(date_format), moment.strftime(time_format)
+
+
+def _row_to_entry(row) -> dict:
+    message_id, sender, content, ts, extra = row
+    date_str, time_str = from_timestamp(ts)
+    entry = {"sender": sender, "content": content, "date": date_str, "time": time_str}
+    if extra:
+        entry.update(json.loads(extra))
+    entry["id"] = message_id
+    return entry
+
+
+def _entry_to_row(entry: dict) -> tuple:
+    extra = {
+        key: value
+        for key, value in entry.items()
+        if key not in ("id", "sender", "content", "date", "time")
+    }
+    return (
+        entry["sender"],
+        entry["content"],
+        to_timestamp(entry["date"], entry["time"]),
+        json.dumps(extra, ensure_ascii=False) if extra else None,
+    )
+
+
+class SqliteChatStore:
+    """
+    One chat stored as an SQLite database in WAL mode. Messages get an integer
+    id, an integer timestamp and their position in the chat, all indexed, so
+    lookups by position, id or time range, edits and deletions don't have to
+    rewrite or scan the whole chat. Entries are returned in the same shape as
+    NDJSON lines, plus their "id".
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(schema)
+        self._add_positions()
+
+    def _add_positions(self):
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(messages)")]
+        with self.connection:
+            if "pos" not in columns:
+                self.connection.execute("ALTER TABLE messages ADD COLUMN pos INTEGER")
+            if self.connection.execute(
+                "SELECT 1 FROM messages WHERE pos IS NULL LIMIT 1"
+            ).fetchall():
+                self.connection.execute(
+                    """
+                    UPDATE messages SET pos = numbered.pos
+                    FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY id) - 1 AS pos FROM messages) AS numbered
+                    WHERE messages.id = numbered.id
+                    """
+                )
+        self.connection.executescript(position_schema)
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def append(self, entry: dict) -> int:
+        return self.append_many([entry])[-1]
+
+    def append_many(self, entries: list[dict]) -> list[int]:
+        with self.lock, self.connection:
+            return [
+                self.connection.execute(
+                    "INSERT INTO messages (sender, content, ts, extra, pos) VALUES "
+                    "(?, ?, ?, ?, (SELECT COALESCE(MAX(pos), -1) + 1 FROM messages))",
+                    _entry_to_row(entry),
+                ).lastrowid
+                for entry in entries
+            ]
+
+    def count(self) -> int:
+        return self._query("SELECT COALESCE(MAX(pos), -1) + 1 FROM messages")[0][0]
+
+    def last(self, n: int = None) -> list[dict]:
+        if not n:
+            return self.range(0, -1)
+        rows = self._query(
+            "SELECT id, sender, content, ts, extra FROM messages ORDER BY pos DESC LIMIT ?",
+            (n,),
+        )
+        return [_row_to_entry(row) for row in reversed(rows)]
+
+    def range(self, start: int, stop: int) -> list[dict]:
+        """Messages [start, stop) by position; stop=-1 means until the end"""
+        if stop < 0:
+            rows = self._query(
+                "SELECT id, sender, content, ts, extra FROM messages WHERE pos >= ? ORDER BY pos",
+                (max(start, 0),),
+            )
+        else:
+            rows = self._query(
+                "SELECT id, sender, content, ts, extra FROM messages "
+                "WHERE pos >= ? AND pos < ? ORDER BY pos",
+                (max(start, 0), stop),
+            )
+        return [_row_to_entry(row) for row in rows]
+
+    def between(self, ts_from: int, ts_to: int) -> list[dict]:
+        """Messages with ts_from <= timestamp < ts_to, see to_timestamp"""
+        rows = self._query(
+            "SELECT id, sender, content, ts, extra FROM messages WHERE ts >= ? AND ts < ? ORDER BY id",
+            (ts_from, ts_to),
+        )
+        return [_row_to_entry(row) for row in rows]
+
+    def get(self, message_id: int) -> dict:
+        rows = self._query(
+            "SELECT id, sender, content, ts, extra FROM messages WHERE id = ?",
+            (message_id,),
+        )
+        return _row_to_entry(rows[0]) if rows else None
+
+    def edit(self, message_id: int, content: str):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE messages SET content = ? WHERE id = ?", (content, message_id)
+            )
+
+    def delete(self, message_id: int):
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT pos FROM messages WHERE id = ?", (message_id,)
+            ).fetchall()
+            if not rows:
+                return
+            self.connection.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            # the messages after it move up one place
+            self.connection.execute(
+                "UPDATE messages SET pos = pos - 1 WHERE pos > ?", (rows[0][0],)
+            )
+
+    def compact(self):
+        """Fold the WAL back into the database and reclaim space left by deletions"""
+        with self.lock:
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.connection.execute("VACUUM")
+
+    def import_ndjson(self, ndjson_path: str) -> int:
+        with open(ndjson_path, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        self.append_many(entries)
+        return len(entries)
+
+    def export_ndjson(self, ndjson_path: str, batch_size: int = 10000) -> int:
+        """Write the chat back out in the NDJSON format; ids are dropped"""
+        exported = 0
+        tmp_path = ndjson_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            last_id = 0
+            while True:
+                rows = self._query(
+                    "SELECT id, sender, content, ts, extra FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                )
+                if not rows:
+                    break
+                for row in rows:
+                    entry = _row_to_entry(row)
+                    del entry["id"]
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                exported += len(rows)
+                last_id = rows[-1][0]
+        os.replace(tmp_path, ndjson_path)
+        return exported
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path: str) -> SqliteChatStore:
+    """Shared store per database file, so every handler uses the same connection"""
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = SqliteChatStore(path)
+        return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert chats between NDJSON and SQLite, or compact an SQLite chat."
+    )
+    parser.add_argument("command", choices=["import", "export", "compact"])
+    parser.add_argument("sqlite_path")
+    parser.add_argument("ndjson_path", nargs="?")
+    args = parser.parse_args()
+
+    store = SqliteChatStore(args.sqlite_path)
+    if args.command == "import":
+        print(f"Imported {store.import_ndjson(args.ndjson_path)} messages")
+    elif args.command == "export":
+        print(f"Exported {store.export_ndjson(args.ndjson_path)} messages")
+    else:
+        store.compact()
+    store.close()
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from context_builder import drop_chunk_size, count_message_tokens
+from ollama_backend import Preempted
+
+summaries_filepath = os.path.join("cache", "summaries")
+
+# a level 1 summary covers one chunk of messages, the same chunks history is dropped in
+summary_chunk_size = drop_chunk_size
+# a level n + 1 summary covers this many level n summaries
+summary_fanout = 4
+max_summary_level = 4
+# seconds between checks for idle time and missing summaries
+idle_poll_seconds = 2.0
+# nodes looked up on disk per check before giving the loop back
+checks_per_poll = 64
+
+summary_instructions = (
+    "Summarize the following part of a text message conversation in a few "
+    "sentences. Keep names, facts, plans, promises, feelings and anything the "
+    "participants would remember later. Reply with the summary only."
+)
+
+
+def node_size(level: int) -> int:
+    return summary_chunk_size * summary_fanout ** (level - 1)
+
+
+def _hash(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ContextStats:
+    """Running totals comparing prompts built from raw history with summarized ones"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.modes = {}
+        self.replaced_tokens = 0
+        self.summary_tokens = 0
+
+    def record_reduction(self, replaced_tokens: int, summary_tokens: int):
+        with self.lock:
+            self.replaced_tokens += replaced_tokens
+            self.summary_tokens += summary_tokens
+
+    def record(self, mode: str, stats: dict):
+        """stats are the prompt_eval_* counters Ollama returns with a finished reply"""
+        if not stats or not stats.get("prompt_eval_count"):
+            return
+        with self.lock:
+            totals = self.modes.setdefault(
+                mode, {"replies": 0, "prompt_tokens": 0, "prompt_eval_ns": 0}
+            )
+            totals["replies"] += 1
+            totals["prompt_tokens"] += stats["prompt_eval_count"]
+            totals["prompt_eval_ns"] += stats.get("prompt_eval_duration") or 0
+
+    def report(self) -> str:
+        with self.lock:
+            lines = []
+            for mode, totals in sorted(self.modes.items()):
+                replies = totals["replies"]
+                lines.append(
+                    f"{mode}: {replies} replies, "
+                    f"{totals['prompt_tokens'] / replies:.0f} prompt tokens and "
+                    f"{totals['prompt_eval_ns'] / replies / 1e6:.0f} ms prefill on average"
+                )
+            if self.replaced_tokens:
+                saved = 1 - self.summary_tokens / self.replaced_tokens
+                lines.append(
+                    f"summaries stood in for {self.replaced_tokens} tokens of history "
+                    f"using {self.summary_tokens} ({saved:.0%} fewer)"
+                )
+            return "\n".join(lines) or "No replies recorded yet."
+
+
+class Summarizer:
+    """
+    Compresses old chat history into a hierarchy of summaries in a background
+    thread, only while generate_is_idle() says the backend has nothing else
+    to do. Every summary is cached on disk under a key made of the chat, the
+    message range, a hash of its content and the model, so it is never
+    computed twice. The reply path only ever reads summaries that already exist.
+
+    load_range(chat_filename, start, stop) reads messages from any backend and
+    generate(model, prompt) returns the model's reply as text.
+    """
+
+    def __init__(self, load_range, generate, generate_is_idle):
+        self.load_range = load_range
+        self.generate = generate
+        self.generate_is_idle = generate_is_idle
+        self.lock = threading.Lock()
+        # chat -> (model, index summaries are wanted below)
+        self.wanted = {}
+        # (chat, model, level, start) -> {"summary", "hash", "source_tokens"}
+        self.nodes = {}
+        self.stats = ContextStats()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def _node_path(self, chat_filename, model, level, start, content_hash) -> str:
+        key = _hash(chat_filename, level, start, start + node_size(level), content_hash, model)
+        return os.path.join(summaries_filepath, key + ".json")
+
+    def request(self, chat_filename: str, model: str, upto: int):
+        """Ask for summaries of everything before message index upto"""
+        with self.lock:
+            self.wanted[chat_filename] = (model, upto)
+
+    def summaries_before(
+        self, chat_filename: str, model: str, upto: int, budget: int
+    ) -> tuple[list[str], int]:
+        """
+        Already computed summaries of messages before upto, oldest first,
+        within budget tokens, and the number of history tokens they replace.
+        Walking back from upto, the recent past is covered by the finest
+        summaries available and older stretches by coarser ones as the budget
+        runs out.
+        """
+        picked = []
+        spent = 0
+        replaced = 0
+        end = upto - upto % summary_chunk_size
+        with self.lock:
+            while end > 0:
+                available = []
+                for level in range(1, max_summary_level + 1):
+                    size = node_size(level)
+                    if end % size or end < size:
+                        break
+                    node = self.nodes.get((chat_filename, model, level, end - size))
+                    if node is not None:
+                        available.append((level, node))
+                if not available:
+                    break
+                level, node = available[0] if spent < budget / 2 else available[-1]
+                cost = count_message_tokens({"content": node["summary"]})
+                if spent + cost > budget:
+                    break
+                picked.append(node["summary"])
+                spent += cost
+                replaced += node["source_tokens"]
+                end -= node_size(level)
+        picked.reverse()
+        return picked, replaced
+
+    def _leaf_source(self, chat_filename: str, start: int):
+        entries = self.load_range(chat_filename, start, start + summary_chunk_size)
+        if len(entries) < summary_chunk_size:
+            return None
+        lines = [
+            f"[{e['date']} at {e['time']}] {e['sender']}: {e['content']}"
+            for e in entries
+            if not e.get("unreadable")
+        ]
+        text = "\n".join(lines)
+        return text, _hash(text), count_message_tokens({"content": text})
+
+    def _parent_source(self, chat_filename: str, model: str, level: int, start: int):
+        child_size = node_size(level - 1)
+        children = [
+            self.nodes.get((chat_filename, model, level - 1, start + i * child_size))
+            for i in range(summary_fanout)
+        ]
+        if any(child is None for child in children):
+            return None
+        text = "\n\n".join(child["summary"] for child in children)
+        content_hash = _hash(*(child["hash"] for child in children))
+        return text, content_hash, sum(child["source_tokens"] for child in children)
+
+    def _ensure(self, chat_filename, model, level, start) -> bool:
+        """Load or compute one node; returns True if a model call was made"""
+        if level == 1:
+            source = self._leaf_source(chat_filename, start)
+        else:
+            source = self._parent_source(chat_filename, model, level, start)
+        if source is None:
+            return False
+        text, content_hash, source_tokens = source
+
+        path = self._node_path(chat_filename, model, level, start, content_hash)
+        computed = False
+        try:
+            with open(path, encoding="utf-8") as f:
+                summary = json.load(f)["summary"]
+        except (FileNotFoundError, ValueError, KeyError):
+            summary = self.generate(model, f"{summary_instructions}\n\n{text}")
+            os.makedirs(summaries_filepath, exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "chat": chat_filename,
+                        "level": level,
+                        "start": start,
+                        "stop": start + node_size(level),
+                        "hash": content_hash,
+                        "model": model,
+                        "summary": summary,
+                    },
+                    f,
+                    ensure_ascii=False,
+                )
+            os.replace(tmp_path, path)
+            computed = True
+
+        with self.lock:
+            self.nodes[(chat_filename, model, level, start)] = {
+                "summary": summary,
+                "hash": content_hash,
+                "source_tokens": source_tokens,
+            }
+        return computed
+
+    def _missing_nodes(self):
+        """Nodes worth having, newest first, finer levels before coarser ones"""
+        with self.lock:
+            wanted = list(self.wanted.items())
+        for chat_filename, (model, upto) in wanted:
+            for level in range(1, max_summary_level + 1):
+                size = node_size(level)
+                start = (upto // size - 1) * size
+                while start >= 0:
+                    with self.lock:
+                        known = (chat_filename, model, level, start) in self.nodes
+                    if not known:
+                        yield chat_filename, model, level, start
+                    start -= size
+
+    def _work(self):
+        while True:
+            time.sleep(idle_poll_seconds)
+            checked = 0
+            for node in self._missing_nodes():
+                if not self.generate_is_idle() or checked >= checks_per_poll:
+                    break
+                try:
+                    if self._ensure(*node):
+                        # one model call at a time, then check for idleness again
+                        break
+                except Preempted:
+                    # a reply needed the model; the node is tried again once idle
+                    break
+                except Exception as e:
+                    print(f"Could not summarize {node}: {e}")
+                    break
+                checked += 1
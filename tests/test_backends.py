@@ -0,0 +1,117 @@
+import socket
+
+import pytest
+
+from benchmark import start_mock_ollama, mock_model
+from ollama_backend import BackendPool
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(models=(mock_model,)):
+        server = start_mock_ollama(0.01, 0.5, 8, models)
+        started.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def dead_url() -> str:
+    """A local port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def chat(pool: BackendPool, model: str, chat_key: str, options: dict = None):
+    job = pool.submit(model, chat_key, [{"role": "user", "content": "hi"}], options)
+    return job, job.result()
+
+
+def test_failover_skips_a_dead_endpoint(servers):
+    pool = BackendPool(
+        endpoints=[
+            {"kind": "ollama", "url": dead_url(), "name": "dead"},
+            {"kind": "ollama", "url": servers(), "name": "live"},
+        ],
+        routing="least_loaded",
+    )
+    pool.list_models(10)
+    dead = pool.router.endpoints[0]
+    assert not dead.healthy
+    # as if it had died after its last health check, so the request tries it first
+    dead.healthy = True
+
+    job, text = chat(pool, mock_model, "chat")
+
+    assert text
+    assert job.endpoint == "live"
+    assert not dead.healthy
+
+
+def test_model_only_goes_to_servers_that_list_it(servers):
+    pool = BackendPool(
+        endpoints=[
+            {"kind": "ollama", "url": servers(["a:latest"]), "name": "a"},
+            {"kind": "ollama", "url": servers(["b:latest"]), "name": "b"},
+        ]
+    )
+    assert pool.list_models(10) == ["a:latest", "b:latest"]
+
+    for index in range(6):
+        assert chat(pool, "a:latest", f"chat {index}")[0].endpoint == "a"
+        assert chat(pool, "b:latest", f"chat {index}")[0].endpoint == "b"
+
+
+def test_affinity_keeps_a_chat_on_one_server(servers):
+    pool = BackendPool(
+        endpoints=[
+            {"kind": "ollama", "url": servers(), "name": "one"},
+            {"kind": "ollama", "url": servers(), "name": "two"},
+        ]
+    )
+    pool.list_models(10)
+
+    picked = {
+        chat_key: {chat(pool, mock_model, chat_key)[0].endpoint for _ in range(3)}
+        for chat_key in (f"chat {index}" for index in range(8))
+    }
+
+    assert all(len(endpoints) == 1 for endpoints in picked.values())
+    assert set().union(*picked.values()) == {"one", "two"}
+
+
+def test_openai_compatible_endpoint(servers):
+    pool = BackendPool(endpoints=[{"kind": "openai", "url": servers(), "name": "openai"}])
+    assert pool.list_models(10) == [mock_model]
+
+    job, text = chat(pool, mock_model, "chat", {"num_predict": 3})
+
+    assert job.endpoint == "openai"
+    assert len(text.split()) == 3
+    assert job.stats["eval_count"] == 3
+    assert job.stats["prompt_eval_count"] >= 1
+    assert job.time_to_first_token is not None
+
+
+def test_embeddings_go_to_a_server_with_the_model(servers):
+    pool = BackendPool(
+        endpoints=[
+            {"kind": "ollama", "url": dead_url(), "name": "dead"},
+            {"kind": "openai", "url": servers([mock_model]), "name": "chat only"},
+            {"kind": "openai", "url": servers(["embed:latest"]), "name": "embed"},
+        ]
+    )
+    pool.list_models(10)
+
+    vectors = pool.embed("embed:latest", ["hello", "world"])
+
+    assert len(vectors) == 2
+    assert vectors[0] != vectors[1]
+    assert len(vectors[0]) == len(vectors[1]) > 0